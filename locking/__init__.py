@@ -5,5 +5,26 @@ import logging
 import urls
 
 LOCK_TIMEOUT = getattr(settings, 'LOCK_TIMEOUT', 1800)
+# how often (in seconds) an open edit page renews its lock, if at all
+LOCK_RENEWAL_INTERVAL = getattr(settings, 'LOCK_RENEWAL_INTERVAL', None)
+# how long (in seconds) a request may wait for a lock to change, if at all
+LOCK_POLL_TIMEOUT = getattr(settings, 'LOCK_POLL_TIMEOUT', None)
+# how long (in seconds) to remember whether a user may change a model
+LOCK_PERMISSION_CACHE_TIMEOUT = getattr(settings, 'LOCK_PERMISSION_CACHE_TIMEOUT', 300)
+# whether to release a user's locks when they log out or their session expires
+LOCK_RELEASE_ON_LOGOUT = getattr(settings, 'LOCK_RELEASE_ON_LOGOUT', True)
+# how many live sessions to look through for another session of the same user,
+# before giving up and assuming there is one
+LOCK_SESSION_SCAN_LIMIT = getattr(settings, 'LOCK_SESSION_SCAN_LIMIT', 1000)
+LOCK_BACKEND = getattr(settings, 'LOCK_BACKEND', 'locking.backends.DatabaseBackend')
+LOCK_CACHE = getattr(settings, 'LOCK_CACHE', None)
+# how long (in seconds) the database backend may cache lock status lookups, if at all
+LOCK_STATUS_CACHE_TIMEOUT = getattr(settings, 'LOCK_STATUS_CACHE_TIMEOUT', 0)
+LOCK_METRICS = getattr(settings, 'LOCK_METRICS', None)
+# whether to keep a history of lock events, and how to buffer it (see ``locking.history``)
+LOCK_HISTORY = getattr(settings, 'LOCK_HISTORY', False)
+LOCK_HISTORY_BATCH_SIZE = getattr(settings, 'LOCK_HISTORY_BATCH_SIZE', 500)
+LOCK_HISTORY_FLUSH_INTERVAL = getattr(settings, 'LOCK_HISTORY_FLUSH_INTERVAL', 5)
+LOCK_HISTORY_QUEUE_SIZE = getattr(settings, 'LOCK_HISTORY_QUEUE_SIZE', 10000)
 
 logger = logging.getLogger('django.locker')
\ No newline at end of file
@@ -3,12 +3,84 @@
 from datetime import datetime
 
 from django.contrib import admin
+from django.contrib.admin.filterspecs import FilterSpec
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext as _
 from django import forms
 
 from locking import LOCK_TIMEOUT, views
+from locking.backends import get_backend, lock_state_sql
+
+# the query string parameter for the lock filter
+LOCK_VAR = 'lock'
+
+class LockFilterSpec(FilterSpec):
+    """ Filters the changelist down to locked, unlocked or your own locked
+    objects. Unlike other filters, it isn't tied to a field. """
+    def __init__(self, request, params):
+        self.params = params
+        self.value = params.get(LOCK_VAR)
+
+    def title(self):
+        return _('lock')
+
+    def choices(self, cl):
+        for value, display in ((None, _('All')), ('locked', _('Locked')), 
+            ('unlocked', _('Unlocked')), ('mine', _('Locked by me'))):
+            yield {
+                'selected': self.value == value,
+                'query_string': cl.get_query_string({LOCK_VAR: value}),
+                'display': display,
+                }
+
+class LockableChangeList(ChangeList):
+    def __init__(self, request, *vargs, **kwargs):
+        self.request = request
+        super(LockableChangeList, self).__init__(request, *vargs, **kwargs)
+
+    def get_query_set(self):
+        # ChangeList takes every parameter it doesn't know for a field 
+        # lookup, so we hide ours while it builds the queryset
+        params = self.params
+        self.params = dict((k, v) for k, v in params.items() if k != LOCK_VAR)
+        try:
+            qs = super(LockableChangeList, self).get_query_set()
+        finally:
+            self.params = params
+        
+        # the lock filters narrow the queryset down in the database
+        value = params.get(LOCK_VAR)
+        if value not in (None, 'locked', 'unlocked', 'mine'):
+            raise IncorrectLookupParameters
+        if value is None:
+            return qs
+        backend = get_backend()
+        try:
+            qs = backend.with_lock_state(qs)
+        except NotImplementedError:
+            if value == 'locked':
+                return backend.locked(qs)
+            elif value == 'unlocked':
+                return backend.unlocked(qs)
+            else:
+                return backend.held_by(qs, self.request.user)
+        # The lock column goes by an object's own lock, so when the database
+        # can tell, the filters do the same, by the same (database) clock 
+        # as ``lock_is_active``, rather than by the clock of this process.
+        is_active = lock_state_sql(qs)['lock_is_active']
+        if value == 'locked':
+            return qs.extra(where=['%s = 1' % is_active])
+        elif value == 'unlocked':
+            return qs.extra(where=['%s = 0' % is_active])
+        else:
+            return qs.extra(where=['%s = 1' % is_active]).filter(_locked_by=self.request.user)
+
+    def get_filters(self, request):
+        filter_specs, has_filters = super(LockableChangeList, self).get_filters(request)
+        return [LockFilterSpec(request, self.params)] + filter_specs, True
 
 class LockableAdmin(admin.ModelAdmin):
     @property
@@ -31,12 +103,20 @@ class LockableAdmin(admin.ModelAdmin):
             'http://ajax.googleapis.com/ajax/libs/jquery/1.4.2/jquery.min.js', 
             'locking/js/jquery.url.packed.js',
             #reverse('django.views.i18n.javascript_catalog'),
-            reverse('locking_variables'),
+            reverse('locking_variables') + '?v=' + views.JS_VARIABLES_VERSION,
             'locking/js/admin.locking.js',
             )
         
         return forms.Media(css=css, js=js)
     
+    def queryset(self, request):
+        # the lock column needs the lock and lock holder of every object
+        # on the page, so we fetch those in bulk
+        return super(LockableAdmin, self).queryset(request).prefetch_locks()
+
+    def get_changelist(self, request, **kwargs):
+        return LockableChangeList
+
     def changelist_view(self, request, extra_context=None):
         # we need the request objects in a few places where it's usually not present, 
         # so we're tacking it on to the LockableAdmin class
@@ -45,6 +125,8 @@ class LockableAdmin(admin.ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         # object creation doesn't need/have locking in place
+        # (unlocking only changes the lock fields in memory; they get written
+        # out together with the rest of the object, in a single save)
         if obj.pk:
             obj.unlock_for(request.user)
         obj.save()
@@ -69,5 +151,8 @@ class LockableAdmin(admin.ModelAdmin):
         else:
             return ''
     lock.allow_tags = True
+    # sorting on when locks expire is sorting on how long they have left,
+    # and can use the index on that column
+    lock.admin_order_field = '_lock_expires_at'
     
     list_display = ('__str__', 'lock')
\ No newline at end of file
@@ -0,0 +1,1023 @@
+# encoding: utf-8
+
+import datetime
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils.encoding import force_unicode
+from django.utils.importlib import import_module
+
+from locking import LOCK_TIMEOUT, LOCK_BACKEND, LOCK_CACHE, LOCK_STATUS_CACHE_TIMEOUT
+from locking import signals
+from locking.registry import lockable_models
+
+"""
+Lock storage backends. The database backend keeps lock state in the
+``locked_at``, ``locked_by``, ``hard_lock`` and ``lock_expires_at`` columns
+``LockableModel`` adds to your tables. The cache backend keeps it in Django's cache framework
+instead, so lock traffic doesn't have to touch your database at all.
+
+Pick one with the ``LOCK_BACKEND`` setting.
+"""
+
+def lock_timeout(model):
+    """ How long (in seconds) locks on ``model`` last: its ``lock_timeout``, 
+    or if it doesn't have one, the ``LOCK_TIMEOUT`` setting. """
+    return getattr(model, 'lock_timeout', None) or LOCK_TIMEOUT
+
+def expiry(model, timeout=None, now=None):
+    """ When a lock on ``model`` taken ``now`` expires: ``timeout`` 
+    seconds later, or if that's not given, after ``lock_timeout(model)``. """
+    if now is None:
+        now = datetime.datetime.today()
+    return now + datetime.timedelta(seconds=timeout or lock_timeout(model))
+
+def lock_ancestors(model):
+    """ The models whose locks cover ``model``, following ``lock_parent``
+    upwards, as ``(lookup prefix, model)`` pairs. For a paragraph with an
+    ``article`` as its lock parent, that's ``[('article__', Article)]``. """
+    ancestors = []
+    prefix = ''
+    while getattr(model, 'lock_parent', None):
+        prefix += model.lock_parent + '__'
+        model = model._meta.get_field(model.lock_parent).rel.to
+        ancestors.append((prefix, model))
+    return ancestors
+
+def lock_descendants(model):
+    """ The models whose objects are covered by locks on ``model``: the 
+    other way around from ``lock_ancestors``, as ``(lookup prefix, model)`` 
+    pairs with the prefix leading up from the descendant. For an article, 
+    that's ``[('article__', Paragraph)]``. """
+    model = concrete_model(model)
+    descendants = []
+    for descendant in lockable_models:
+        if descendant._meta.proxy:
+            continue
+        for prefix, ancestor in lock_ancestors(descendant):
+            if concrete_model(ancestor) is model:
+                descendants.append((prefix, descendant))
+                break
+    return descendants
+
+def acquirable_by(user):
+    """ Matches rows that are unlocked, whose lock has expired or whose lock
+    is held by ``user``: the rows ``user`` may (re)lock. Without ``user``, 
+    this matches the rows nobody holds an active lock on. Locks on ancestors
+    aren't taken into account: see ``acquirable``. """
+    now = datetime.datetime.today()
+    q = Q(_lock_expires_at__isnull=True) | Q(_lock_expires_at__lte=now)
+    if user is not None:
+        q |= Q(_locked_by=user)
+    return q
+
+def _held_sql(connection, alias, model, now, user=None):
+    # an active lock on the row ``alias`` stands for, not held by ``user``
+    qn = connection.ops.quote_name
+    meta = model._meta
+    sql = '%s.%s > %%s' % (alias, qn(meta.get_field('_lock_expires_at').column))
+    params = [now]
+    if user is not None:
+        locked_by = '%s.%s' % (alias, qn(meta.get_field('_locked_by').column))
+        sql += ' AND (%s IS NULL OR %s <> %%s)' % (locked_by, locked_by)
+        params.append(user.pk)
+    return sql, params
+
+def ancestor_lock_sql(queryset, user=None):
+    """ SQL that tells whether an ancestor of a row in ``queryset`` holds an 
+    active lock (that isn't held by ``user``), as a list of ``EXISTS`` 
+    conditions, one per ancestor, and their parameters. 
+    
+    Each is a subquery correlated with the row, rather than a join, so an 
+    ``UPDATE`` that uses these still only involves the table it updates.
+    (Django turns an ``UPDATE`` with joins into a separate ``SELECT`` first,
+    which would let somebody else get in between.) """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    now = connection.ops.value_to_db_datetime(datetime.datetime.today())
+    conditions, params = [], []
+    model = queryset.model
+    if not lock_ancestors(model):
+        return conditions, params
+    # the column that points at the next ancestor up
+    column = '%s.%s' % (qn(model._meta.db_table), 
+        qn(model._meta.get_field(model.lock_parent).column))
+    tables, where = [], None
+    for i, (prefix, ancestor) in enumerate(lock_ancestors(model)):
+        alias = qn('lock_ancestor_%s' % i)
+        meta = ancestor._meta
+        key = '%s.%s' % (alias, 
+            qn(model._meta.get_field(model.lock_parent).rel.get_related_field().column))
+        if tables:
+            tables.append('INNER JOIN %s %s ON %s = %s' % (qn(meta.db_table), alias, key, column))
+        else:
+            tables.append('%s %s' % (qn(meta.db_table), alias))
+            where = '%s = %s' % (key, column)
+        held, held_params = _held_sql(connection, alias, ancestor, now, user)
+        conditions.append('EXISTS (SELECT 1 FROM %s WHERE %s AND %s)' % (
+            ' '.join(tables), where, held))
+        params.extend(held_params)
+        if getattr(ancestor, 'lock_parent', None):
+            column = '%s.%s' % (alias, qn(meta.get_field(ancestor.lock_parent).column))
+        model = ancestor
+    return conditions, params
+
+def descendant_lock_sql(queryset, user=None):
+    """ Like ``ancestor_lock_sql``, but for the descendants of the rows in 
+    ``queryset``: one ``EXISTS`` condition per descendant model, that tells
+    whether somebody other than ``user`` holds an active lock on an object
+    a lock on the row would cover. """
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    now = connection.ops.value_to_db_datetime(datetime.datetime.today())
+    conditions, params = [], []
+    target = concrete_model(queryset.model)
+    for i, (prefix, descendant) in enumerate(lock_descendants(target)):
+        alias = qn('lock_descendant_%s_0' % i)
+        tables = ['%s %s' % (qn(descendant._meta.db_table), alias)]
+        held, held_params = _held_sql(connection, alias, descendant, now, user)
+        # join our way up from the descendant, to the row itself
+        model = descendant
+        for j, (ancestor_prefix, ancestor) in enumerate(lock_ancestors(descendant)):
+            field = model._meta.get_field(model.lock_parent)
+            column = '%s.%s' % (alias, qn(field.column))
+            key = qn(field.rel.get_related_field().column)
+            if concrete_model(ancestor) is target:
+                where = '%s = %s.%s' % (column, qn(target._meta.db_table), key)
+                break
+            alias = qn('lock_descendant_%s_%s' % (i, j + 1))
+            tables.append('INNER JOIN %s %s ON %s.%s = %s' % (
+                qn(ancestor._meta.db_table), alias, alias, key, column))
+            model = ancestor
+        conditions.append('EXISTS (SELECT 1 FROM %s WHERE %s AND %s)' % (
+            ' '.join(tables), where, held))
+        params.extend(held_params)
+    return conditions, params
+
+def _without(queryset, sql):
+    # leaves out the rows any of the ``EXISTS`` conditions in ``sql`` hold for
+    conditions, params = sql
+    if not conditions:
+        return queryset
+    return queryset.extra(where=['NOT ' + condition for condition in conditions], params=params)
+
+def acquirable(queryset, user):
+    """ Narrows ``queryset`` down to the rows ``user`` may (re)lock (see 
+    ``acquirable_by``), that aren't covered by a lock somebody else holds 
+    on one of their ancestors, and whose descendants nobody else holds a
+    lock on either. Without ``user``, this narrows it down to rows that
+    nobody holds an active lock on, directly, through an ancestor or on a
+    descendant. """
+    queryset = queryset.filter(acquirable_by(user))
+    queryset = _without(queryset, ancestor_lock_sql(queryset, user))
+    return _without(queryset, descendant_lock_sql(queryset, user))
+
+# How to ask the database what time it is, for ``with_lock_state``. 
+# Lock timestamps are naive local times, so these stick to local time too.
+# ``now`` is the current time, and ``age`` the amount of seconds that
+# have passed since a timestamp.
+SQL_CLOCKS = {
+    'postgresql': {
+        'now': "LOCALTIMESTAMP",
+        'age': "CAST(EXTRACT(EPOCH FROM (LOCALTIMESTAMP - %s)) AS INTEGER)",
+        },
+    'mysql': {
+        'now': "NOW()",
+        'age': "TIMESTAMPDIFF(SECOND, %s, NOW())",
+        },
+    'sqlite': {
+        'now': "datetime('now', 'localtime')",
+        'age': "CAST((julianday('now', 'localtime') - julianday(%s)) * 86400 AS INTEGER)",
+        },
+    'oracle': {
+        'now': "LOCALTIMESTAMP",
+        'age': "ROUND((CAST(LOCALTIMESTAMP AS DATE) - CAST(%s AS DATE)) * 86400)",
+        },
+    }
+
+def lock_state_sql(queryset):
+    """ The SQL expressions behind ``with_lock_state``, for the rows in 
+    ``queryset``: a dictionary with ``lock_is_active`` and ``lock_expires_in``.
+    Unlike the names ``with_lock_state`` selects these under, the expressions
+    themselves can go in a ``WHERE`` clause. """
+    connection = connections[queryset.db]
+    try:
+        clock = SQL_CLOCKS[connection.vendor]
+    except KeyError:
+        raise NotImplementedError("Can't compute lock state on %s" % connection.vendor)
+    qn = connection.ops.quote_name
+    field = queryset.model._meta.get_field('_lock_expires_at')
+    column = '%s.%s' % (qn(queryset.model._meta.db_table), qn(field.column))
+    return {
+        'lock_is_active': 'CASE WHEN %s > %s THEN 1 ELSE 0 END' % (column, clock['now']),
+        'lock_expires_in': '-(%s)' % (clock['age'] % column),
+        }
+
+_skip_locked = {}
+
+def supports_skip_locked(using):
+    """ Whether the database ``using`` refers to can ``SELECT ... FOR UPDATE
+    SKIP LOCKED``: PostgreSQL 9.5 and up, MySQL 8 and up and MariaDB 10.6 and up. """
+    if using not in _skip_locked:
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            from django.db.backends.postgresql.version import get_version
+            supported = get_version(connection.cursor())[:2] >= (9, 5)
+        elif connection.vendor == 'mysql':
+            # MariaDB versions are well past 8, and it has SKIP LOCKED since 10.6
+            version = connection.get_server_version()
+            supported = version >= (10, 6) or (10 > version[0] >= 8)
+        else:
+            supported = False
+        _skip_locked[using] = supported
+    return _skip_locked[using]
+
+def concrete_model(model):
+    # proxy models (including the deferred models ``only`` and ``defer``
+    # create behind the scenes) share their locks with the model they proxy
+    while model._meta.proxy:
+        model = model._meta.proxy_for_model
+    return model
+
+def lock_cache():
+    """ The cache named in the ``LOCK_CACHE`` setting, or the default cache. """
+    from django.core import cache as caches
+    if LOCK_CACHE:
+        return caches.get_cache(LOCK_CACHE)
+    else:
+        return caches.cache
+
+class Lock(object):
+    """ A snapshot of the lock on a single object, as a backend stores it. """
+
+    def __init__(self, locked_at=None, locked_by_id=None, username=None, hard_lock=False, expires_at=None):
+        self.locked_at = locked_at
+        self.locked_by_id = locked_by_id
+        self.username = username
+        self.hard_lock = hard_lock
+        self.expires_at = expires_at
+
+    @property
+    def is_active(self):
+        return self.expires_at is not None and self.expires_at > datetime.datetime.today()
+
+    def applies_to(self, user):
+        return self.is_active and self.locked_by_id != user.pk
+
+    @property
+    def seconds_remaining(self):
+        """ Seconds until this lock expires, or 0 if it isn't active. """
+        if not self.is_active:
+            return 0
+        remaining = self.expires_at - datetime.datetime.today()
+        return remaining.days * 86400 + remaining.seconds
+
+class BaseBackend(object):
+    # Whether lock state is saved along with the rest of the object when
+    # calling ``LockableModel.save``, or needs to be stored separately.
+    persists_with_model = False
+
+    def acquire(self, model, pk, user, hard_lock=False, timeout=None):
+        """ Locks a single object for ``user``, if nobody else holds a lock
+        on it. Returns True if the lock was acquired. This should be atomic. 
+        The lock lasts ``timeout`` seconds, or by default ``lock_timeout(model)``. """
+        raise NotImplementedError
+
+    def release(self, model, pk, user=None):
+        """ Unlocks a single object. If ``user`` is given, only a lock held by
+        that user is released. Returns True if a lock was released. """
+        raise NotImplementedError
+
+    def renew(self, model, pk, user, timeout=None):
+        """ Extends an active lock held by ``user`` for another ``timeout``
+        seconds (by default, ``lock_timeout(model)``). Returns False, without 
+        renewing anything, if ``user`` doesn't hold an active lock on the object. """
+        raise NotImplementedError
+
+    def get(self, model, pk):
+        """ Returns the ``Lock`` currently stored for an object. """
+        raise NotImplementedError
+
+    def acquire_many(self, model, pks, user, hard_lock=False, timeout=None):
+        """ Like ``acquire``, for many objects of the same model at once.
+        Returns the set of primary keys (as unicode) that were locked. """
+        return set(force_unicode(pk) for pk in pks 
+            if self.acquire(model, pk, user, hard_lock, timeout))
+
+    def release_many(self, model, pks, user=None):
+        """ Like ``release``, for many objects of the same model at once.
+        Returns the set of primary keys (as unicode) that were unlocked. """
+        return set(force_unicode(pk) for pk in pks 
+            if self.release(model, pk, user))
+
+    def get_many(self, model, pks):
+        """ Like ``get``, for many objects of the same model at once.
+        Returns a dictionary of ``Lock`` objects, keyed by primary key (as unicode). """
+        return dict((force_unicode(pk), self.get(model, pk)) for pk in pks)
+
+    def get_blocking(self, model, pk, user):
+        """ The lock that keeps ``user`` from locking an object: its own lock
+        or, if that doesn't apply to ``user``, the first lock on one of its
+        ancestors or descendants that does. If none of them does, that's its
+        own lock. """
+        return self.get_blocking_many(model, [pk], user)[force_unicode(pk)]
+
+    def get_blocking_many(self, model, pks, user):
+        """ Like ``get_blocking``, for many objects of the same model at once.
+        Returns a dictionary of ``Lock`` objects, keyed by primary key (as unicode). """
+        locks = self.get_many(model, pks)
+        rest = [pk for pk in pks if not locks[force_unicode(pk)].applies_to(user)]
+        if rest:
+            ancestors = self.get_ancestor_locks(model, rest)
+            descendants = self.get_descendant_locks(model, rest)
+            for pk in map(force_unicode, rest):
+                for lock in ancestors[pk] + descendants[pk]:
+                    if lock.applies_to(user):
+                        locks[pk] = lock
+                        break
+        return locks
+
+    def get_ancestor_locks(self, model, pks):
+        """ The locks on the ancestors of these objects (see ``lock_ancestors``),
+        nearest first, as a dictionary of lists of ``Lock`` objects, keyed by 
+        primary key (as unicode). That's a query for the ancestors' keys, plus
+        a ``get_many`` for every ancestor model. """
+        result = dict((force_unicode(pk), []) for pk in pks)
+        ancestors = lock_ancestors(model)
+        if not ancestors or not pks:
+            return result
+        rows = model.objects.filter(pk__in=pks).values_list('pk', 
+            *[prefix + 'pk' for prefix, ancestor in ancestors])
+        for i, (prefix, ancestor) in enumerate(ancestors):
+            locks = self.get_many(ancestor, set(row[i + 1] for row in rows if row[i + 1] is not None))
+            for row in rows:
+                if row[i + 1] is not None:
+                    result[force_unicode(row[0])].append(locks[force_unicode(row[i + 1])])
+        return result
+
+    def get_descendant_locks(self, model, pks):
+        """ The active locks on objects that a lock on these objects would 
+        cover (see ``lock_descendants``), as a dictionary of lists of ``Lock``
+        objects, keyed by primary key (as unicode). """
+        result = dict((force_unicode(pk), []) for pk in pks)
+        for prefix, descendant in lock_descendants(model):
+            rows = descendant.objects.filter(**{prefix + 'pk__in': pks}).values_list('pk', prefix + 'pk')
+            locks = self.get_many(descendant, [row[0] for row in rows])
+            for descendant_pk, pk in rows:
+                lock = locks[force_unicode(descendant_pk)]
+                if lock.is_active:
+                    result[force_unicode(pk)].append(lock)
+        return result
+
+    def lock(self, queryset, user, hard_lock=False, timeout=None):
+        """ Locks every object in ``queryset`` that ``user`` may lock.
+        Returns the amount of objects that were locked. """
+        raise NotImplementedError
+
+    def unlock(self, queryset, user=None):
+        """ Unlocks every object in ``queryset`` (that was locked by ``user``).
+        Returns the amount of objects that were unlocked. """
+        raise NotImplementedError
+
+    def acquire_all(self, queryset, user, hard_lock=False, timeout=None):
+        """ Like ``lock``, but tells you what happened. Returns two sets of
+        primary keys (as unicode): the objects that were locked, and those
+        that somebody else holds a lock on. """
+        pks = set(force_unicode(pk) for pk in queryset.values_list('pk', flat=True))
+        acquired = self.acquire_many(queryset.model, pks, user, hard_lock, timeout)
+        return acquired, pks - acquired
+
+    def release_all(self, queryset, user=None):
+        """ Like ``unlock``, but tells you what happened. Returns two sets of
+        primary keys (as unicode): the objects that were unlocked, and those
+        that somebody else holds an active lock on (only if ``user`` is given). """
+        pks = set(force_unicode(pk) for pk in queryset.values_list('pk', flat=True))
+        released = self.release_many(queryset.model, pks, user)
+        held = set()
+        if user is not None:
+            locks = self.get_many(queryset.model, pks - released)
+            held = set(pk for pk, lock in locks.items() if lock.applies_to(user))
+        return released, held
+
+    def locked(self, queryset):
+        """ Narrows ``queryset`` down to objects with an active lock. """
+        raise NotImplementedError
+
+    def held_by(self, queryset, user):
+        """ Narrows ``queryset`` down to objects with an active lock held by ``user``. """
+        raise NotImplementedError
+
+    def with_lock_state(self, queryset):
+        """ Adds ``lock_is_active`` (1 or 0) and ``lock_expires_in`` (in seconds,
+        negative once a lock has expired) to every object in ``queryset``, 
+        computed by the database. """
+        raise NotImplementedError("%s can't compute lock state in the database" % type(self).__name__)
+
+    def claim(self, queryset, n, user, hard_lock=False, timeout=None):
+        """ Locks the first ``n`` objects in ``queryset`` that nobody holds an
+        active lock on, not even ``user``, and returns their primary keys (as
+        unicode). Many processes can claim from the same queryset at once, 
+        and every object gets claimed by only one of them. """
+        claimed, tried = [], set()
+        while len(claimed) < n:
+            candidates = self.unlocked(queryset).exclude(pk__in=tried)
+            candidates = list(candidates.values_list('pk', flat=True)[:n - len(claimed)])
+            if not candidates:
+                break
+            for pk in candidates:
+                tried.add(pk)
+                if self._claim(queryset.model, pk, user, hard_lock, timeout):
+                    claimed.append(force_unicode(pk))
+        return claimed
+
+    def _claim(self, model, pk, user, hard_lock=False, timeout=None):
+        """ Like ``acquire``, but fails if ``user`` already holds the lock as well. """
+        raise NotImplementedError
+
+    def unlocked(self, queryset):
+        """ Narrows ``queryset`` down to objects without an active lock. """
+        raise NotImplementedError
+
+    def sweep(self, model, batch_size=1000):
+        """ Clears out expired locks, at most ``batch_size`` at a time.
+        Returns the amount of locks that were cleared. """
+        raise NotImplementedError
+
+    def load(self, instance):
+        """ Fills in the lock fields on a model instance. """
+        raise NotImplementedError
+
+    def load_many(self, instances):
+        """ Like ``load``, for many model instances at once. """
+        for instance in instances:
+            self.load(instance)
+
+    def save(self, instance):
+        """ Stores the lock fields of a model instance, and nothing else. """
+        raise NotImplementedError
+
+    def invalidate(self, model, pks):
+        """ Forgets anything cached about the locks on these objects. Called
+        whenever a lock is acquired or released. """
+        pass
+
+    def _dump(self, lock):
+        return (lock.locked_at, lock.locked_by_id, lock.username, lock.hard_lock, lock.expires_at)
+
+class DatabaseBackend(BaseBackend):
+    """
+    Stores locks in the lock columns of the lockable model's own table.
+
+    With a ``status_timeout`` (the ``LOCK_STATUS_CACHE_TIMEOUT`` setting), 
+    lock status lookups through ``get`` and ``get_many``, as in the 
+    ``is_locked`` view, are cached for that many seconds. Acquiring or 
+    releasing a lock clears its cached status, but other processes might 
+    still see the old status until it times out if they don't share the cache.
+    """
+    persists_with_model = True
+    # everything we need to build a ``Lock``, in the right order
+    lock_fields = ('_locked_at', '_locked_by', '_locked_by__username', '_hard_lock', '_lock_expires_at')
+
+    def __init__(self, cache=None, status_timeout=LOCK_STATUS_CACHE_TIMEOUT):
+        self.status_timeout = status_timeout
+        if status_timeout and cache is None:
+            cache = lock_cache()
+        self.cache = cache
+
+    def _status_key(self, model, pk):
+        meta = concrete_model(model)._meta
+        return 'locking:status:%s.%s:%s' % (meta.app_label, meta.module_name, pk)
+
+    def invalidate(self, model, pks):
+        if self.status_timeout:
+            self.cache.delete_many([self._status_key(model, pk) for pk in pks])
+
+    def acquire(self, model, pk, user, hard_lock=False, timeout=None):
+        return self.lock(model.objects.filter(pk=pk), user, hard_lock, timeout) > 0
+
+    def release(self, model, pk, user=None):
+        return self.unlock(model.objects.filter(pk=pk), user) > 0
+
+    def renew(self, model, pk, user, timeout=None):
+        # a single UPDATE that only touches the lock timestamps
+        now = datetime.datetime.today()
+        renewed = model.objects.filter(pk=pk, _locked_by=user, 
+            _lock_expires_at__gt=now).update(
+            _locked_at=now,
+            _lock_expires_at=expiry(model, timeout, now),
+            ) > 0
+        # a renewal doesn't send any signals, but it does move the expiry
+        if renewed:
+            self.invalidate(model, [pk])
+        return renewed
+
+    def get(self, model, pk):
+        if self.status_timeout:
+            value = self.cache.get(self._status_key(model, pk))
+            if value is not None:
+                return Lock(*value)
+        rows = model.objects.filter(pk=pk).values_list(*self.lock_fields)
+        if rows:
+            lock = Lock(*rows[0])
+        else:
+            lock = Lock()
+        if self.status_timeout:
+            self.cache.set(self._status_key(model, pk), self._dump(lock), self.status_timeout)
+        return lock
+
+    def acquire_many(self, model, pks, user, hard_lock=False, timeout=None):
+        queryset = model.objects.filter(pk__in=pks)
+        # Rows ``user`` had locked before, whose ancestor somebody else has
+        # locked since, are still locked by ``user``: only those with the 
+        # timestamp of our own UPDATE are the ones we've just (re)locked.
+        now = datetime.datetime.today()
+        self._lock(queryset, user, hard_lock, timeout, now)
+        acquired = queryset.filter(_locked_by=user, _locked_at=now).values_list('pk', flat=True)
+        return set(force_unicode(pk) for pk in acquired)
+
+    def release_many(self, model, pks, user=None):
+        queryset = model.objects.filter(pk__in=pks)
+        if user is not None:
+            queryset = queryset.filter(_locked_by=user)
+        released = set(force_unicode(pk) for pk in queryset.values_list('pk', flat=True))
+        if released:
+            self.unlock(model.objects.filter(pk__in=released), user)
+        return released
+
+    def get_many(self, model, pks):
+        locks = {}
+        if self.status_timeout:
+            keys = dict((self._status_key(model, pk), force_unicode(pk)) for pk in pks)
+            for key, value in self.cache.get_many(keys.keys()).items():
+                locks[keys[key]] = Lock(*value)
+        missing = [pk for pk in pks if force_unicode(pk) not in locks]
+        if missing:
+            fetched = dict((force_unicode(pk), Lock()) for pk in missing)
+            rows = model.objects.filter(pk__in=missing).values_list('pk', *self.lock_fields)
+            for row in rows:
+                fetched[force_unicode(row[0])] = Lock(*row[1:])
+            if self.status_timeout:
+                self.cache.set_many(dict((self._status_key(model, pk), self._dump(lock)) 
+                    for pk, lock in fetched.items()), self.status_timeout)
+            locks.update(fetched)
+        return locks
+
+    def get_descendant_locks(self, model, pks):
+        # only the descendants that are locked, straight from their rows
+        now = datetime.datetime.today()
+        result = dict((force_unicode(pk), []) for pk in pks)
+        for prefix, descendant in lock_descendants(model):
+            rows = descendant.objects.filter(**{prefix + 'pk__in': pks, 
+                '_lock_expires_at__gt': now}).values_list(prefix + 'pk', *self.lock_fields)
+            for row in rows:
+                result[force_unicode(row[0])].append(Lock(*row[1:]))
+        return result
+
+    def lock(self, queryset, user, hard_lock=False, timeout=None):
+        return self._lock(queryset, user, hard_lock, timeout, datetime.datetime.today())
+
+    def _lock(self, queryset, user, hard_lock, timeout, now):
+        # A single conditional UPDATE on a single table, so checking and 
+        # acquiring a lock can't get interleaved with somebody else's. Locks
+        # on ancestors are checked in the same statement, but they live in
+        # other rows: see ``ancestor_lock_sql``.
+        return acquirable(queryset, user).update(
+            _locked_at=now,
+            _locked_by=user,
+            _hard_lock=hard_lock,
+            _lock_expires_at=expiry(queryset.model, timeout, now),
+            )
+
+    def unlock(self, queryset, user=None):
+        if user is not None:
+            queryset = queryset.filter(_locked_by=user)
+        return queryset.update(
+            _locked_at=None,
+            _locked_by=None,
+            _hard_lock=False,
+            _lock_expires_at=None,
+            )
+
+    def acquire_all(self, queryset, user, hard_lock=False, timeout=None):
+        pks = set(force_unicode(pk) for pk in queryset.values_list('pk', flat=True))
+        # Still a single conditional UPDATE. Its timestamp tells the rows
+        # we've just locked apart from the rest afterwards, even if 
+        # ``queryset`` itself filters on lock state (as ``unlocked`` does).
+        now = datetime.datetime.today()
+        self._lock(queryset, user, hard_lock, timeout, now)
+        # MySQL drops the microseconds, so other locks ``user`` took 
+        # in the same second match too: only count those in ``queryset``
+        acquired = queryset.model.objects.filter(_locked_by=user, _locked_at=now)
+        acquired = set(force_unicode(pk) for pk in acquired.values_list('pk', flat=True)) & pks
+        return acquired, pks - acquired
+
+    def release_all(self, queryset, user=None):
+        rows = queryset.filter(_locked_at__isnull=False).values_list('pk', '_locked_by', '_lock_expires_at')
+        released, held = set(), set()
+        now = datetime.datetime.today()
+        for pk, locked_by_id, expires_at in rows:
+            if user is None or locked_by_id == user.pk:
+                released.add(force_unicode(pk))
+            elif expires_at is not None and expires_at > now:
+                held.add(force_unicode(pk))
+        if released:
+            self.unlock(queryset, user)
+        return released, held
+
+    def locked(self, queryset):
+        # a single comparison on an indexed column, 
+        # plus a subquery for every model whose locks cover this one
+        now = datetime.datetime.today()
+        if not lock_ancestors(queryset.model):
+            return queryset.filter(_lock_expires_at__gt=now)
+        connection = connections[queryset.db]
+        qn = connection.ops.quote_name
+        meta = queryset.model._meta
+        conditions, params = ancestor_lock_sql(queryset)
+        conditions.insert(0, '%s.%s > %%s' % (qn(meta.db_table), 
+            qn(meta.get_field('_lock_expires_at').column)))
+        params.insert(0, connection.ops.value_to_db_datetime(now))
+        return queryset.extra(where=['(%s)' % ' OR '.join(conditions)], params=params)
+
+    def held_by(self, queryset, user):
+        # ``_locked_by`` is a foreign key, so it's indexed; 
+        # this only looks at the object's own lock, not its ancestors'
+        now = datetime.datetime.today()
+        return queryset.filter(_lock_expires_at__gt=now, _locked_by=user)
+
+    def with_lock_state(self, queryset):
+        # ``extra`` is as far as Django 1.3 goes in terms of annotating
+        # objects with SQL expressions
+        return queryset.extra(select=lock_state_sql(queryset))
+
+    def claim(self, queryset, n, user, hard_lock=False, timeout=None):
+        if not supports_skip_locked(queryset.db):
+            # one conditional UPDATE per object, which is correct on any 
+            # database, but on e.g. SQLite, claims have to take turns
+            return super(DatabaseBackend, self).claim(queryset, n, user, hard_lock, timeout)
+
+        # Lock the rows we're after in the database, skipping over rows that 
+        # other workers are claiming right now, and lock them for ``user`` 
+        # before the database releases them again. ``acquirable`` checks the 
+        # locks on ancestors and descendants with subqueries, not joins, so
+        # only rows of this table get locked (PostgreSQL won't lock the 
+        # nullable side of an outer join anyway).
+        candidates = acquirable(queryset, None).values_list('pk', flat=True)[:n]
+        sql, params = candidates.query.get_compiler(queryset.db).as_sql()
+        manage = not transaction.is_managed(using=queryset.db)
+        if manage:
+            transaction.enter_transaction_management(using=queryset.db)
+            transaction.managed(True, using=queryset.db)
+        try:
+            cursor = connections[queryset.db].cursor()
+            cursor.execute(sql + ' FOR UPDATE SKIP LOCKED', params)
+            pks = [row[0] for row in cursor.fetchall()]
+            if pks:
+                now = datetime.datetime.today()
+                queryset.model.objects.using(queryset.db).filter(pk__in=pks).update(
+                    _locked_at=now,
+                    _locked_by=user,
+                    _hard_lock=hard_lock,
+                    _lock_expires_at=expiry(queryset.model, timeout, now),
+                    )
+        except:
+            if manage:
+                transaction.rollback(using=queryset.db)
+            raise
+        else:
+            if manage:
+                transaction.commit(using=queryset.db)
+        finally:
+            if manage:
+                transaction.leave_transaction_management(using=queryset.db)
+        return [force_unicode(pk) for pk in pks]
+
+    def _claim(self, model, pk, user, hard_lock=False, timeout=None):
+        now = datetime.datetime.today()
+        return acquirable(model.objects.filter(pk=pk), None).update(
+            _locked_at=now,
+            _locked_by=user,
+            _hard_lock=hard_lock,
+            _lock_expires_at=expiry(model, timeout, now),
+            ) > 0
+
+    def unlocked(self, queryset):
+        # like the ``locked`` it complements, this leaves descendants out
+        queryset = queryset.filter(acquirable_by(None))
+        return _without(queryset, ancestor_lock_sql(queryset))
+
+    def sweep(self, model, batch_size=1000):
+        cleared = 0
+        while True:
+            now = datetime.datetime.today()
+            # locks from before lock expiry was stored have expired too
+            expired = model.objects.filter(Q(_lock_expires_at__lte=now) | 
+                Q(_lock_expires_at__isnull=True, _locked_at__isnull=False))
+            pks = list(expired.values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                break
+            # a lock might have been renewed in the meantime
+            cleared += expired.filter(pk__in=pks).update(
+                _locked_at=None,
+                _locked_by=None,
+                _hard_lock=False,
+                _lock_expires_at=None,
+                )
+            if len(pks) < batch_size:
+                break
+        return cleared
+
+    def load(self, instance):
+        # the lock fields were loaded along with the rest of the row
+        pass
+
+    def load_many(self, instances):
+        pass
+
+    def save(self, instance):
+        type(instance).objects.filter(pk=instance.pk).update(
+            _locked_at=instance._locked_at,
+            _locked_by=instance._locked_by,
+            _hard_lock=instance._hard_lock,
+            _lock_expires_at=instance._lock_expires_at,
+            )
+
+class CacheBackend(BaseBackend):
+    """
+    Stores locks in Django's cache framework, using the cache configured
+    in the ``LOCK_CACHE`` setting, or the default cache. Locks are acquired
+    with an atomic ``add`` and expire by themselves, through the cache timeout.
+
+    The cache can't be queried, so for every lockable model we also keep an
+    index of the objects that were locked. The ``locked`` and ``unlocked``
+    querysets are built from that index, after double-checking it against
+    the locks themselves.
+
+    Use a cache that is shared between all of your processes (e.g. memcached).
+    A local-memory cache only works for a single process, which is fine for
+    testing.
+    """
+    # How long to wait for another process to finish updating an index.
+    # This happens in the middle of a request, so we don't wait for long:
+    # if we can't get to the index, we leave it be (see ``_update_index``).
+    index_retries = 3
+    index_retry_delay = 0.005
+
+    def __init__(self, cache=None):
+        if cache is None:
+            cache = lock_cache()
+        self.cache = cache
+
+    def _key(self, model, pk):
+        meta = concrete_model(model)._meta
+        return 'locking:%s.%s:%s' % (meta.app_label, meta.module_name, pk)
+
+    def _index_key(self, model):
+        meta = concrete_model(model)._meta
+        return 'locking:%s.%s' % (meta.app_label, meta.module_name)
+
+    def _lock_index(self, key):
+        mutex = key + ':mutex'
+        for attempt in range(self.index_retries):
+            if attempt:
+                time.sleep(self.index_retry_delay)
+            if self.cache.add(mutex, 1, 5):
+                return True
+        return False
+
+    def _write_index(self, key, index):
+        # every entry in the index has expired by the time the index does
+        now = datetime.datetime.today()
+        index = dict((k, v) for k, v in index.items() if v > now)
+        if index:
+            remaining = max(index.values()) - now
+            self.cache.set(key, index, remaining.days * 86400 + remaining.seconds + 1)
+        else:
+            self.cache.delete(key)
+
+    def _update_index(self, model, pk, expires_at):
+        key = self._index_key(model)
+        if not self._lock_index(key):
+            # Another process is busy with the index. Rather than risk 
+            # overwriting its changes, we leave our lock out, and mark the
+            # index as incomplete until that lock expires. Readers then look 
+            # at every lock (see ``_locked_pks``) until ``sweep`` rebuilds
+            # the index. An unlock that doesn't make it into the index is 
+            # harmless: readers double-check the index against the locks.
+            if expires_at is not None:
+                stale = self.cache.get(key + ':stale')
+                if stale is None or stale < expires_at:
+                    remaining = expires_at - datetime.datetime.today()
+                    self.cache.set(key + ':stale', expires_at, 
+                        remaining.days * 86400 + remaining.seconds + 1)
+            return
+        try:
+            index = self.cache.get(key) or {}
+            if pk is None:
+                pass
+            elif expires_at is None:
+                index.pop(force_unicode(pk), None)
+            else:
+                index[force_unicode(pk)] = expires_at
+            self._write_index(key, index)
+        finally:
+            self.cache.delete(key + ':mutex')
+
+    def _rebuild_index(self, model):
+        # Looks up the lock on every object, to replace an incomplete index.
+        # The marker goes first, so that a lock that misses the index while
+        # we're at it marks it as incomplete again.
+        key = self._index_key(model)
+        if self.cache.get(key + ':stale') is None or not self._lock_index(key):
+            return
+        try:
+            self.cache.delete(key + ':stale')
+            pks = concrete_model(model).objects.values_list('pk', flat=True)
+            locks = self.get_many(model, pks)
+            self._write_index(key, dict((pk, lock.expires_at) 
+                for pk, lock in locks.items() if lock.is_active))
+        finally:
+            self.cache.delete(key + ':mutex')
+
+    def _set(self, model, pk, lock):
+        # the cache expires the lock at the same time it times out
+        if lock.is_active:
+            self.cache.set(self._key(model, pk), self._dump(lock), lock.seconds_remaining + 1)
+            self._update_index(model, pk, lock.expires_at)
+        else:
+            self._delete(model, pk)
+
+    def _delete(self, model, pk):
+        self.cache.delete(self._key(model, pk))
+        self._update_index(model, pk, None)
+
+    def _locked_pks(self, model, user=None):
+        key = self._index_key(model)
+        if self.cache.get(key + ':stale') is None:
+            pks = self.cache.get(key) or {}
+        else:
+            # some locks are missing from the index
+            pks = concrete_model(model).objects.values_list('pk', flat=True)
+        keys = dict((self._key(model, pk), force_unicode(pk)) for pk in pks)
+        found = self.cache.get_many(keys.keys())
+        locks = [(keys[key], Lock(*value)) for key, value in found.items()]
+        return [pk for pk, lock in locks if lock.is_active 
+            and (user is None or lock.locked_by_id == user.pk)]
+
+    def _new_lock(self, model, user, hard_lock=False, timeout=None):
+        now = datetime.datetime.today()
+        return Lock(now, user.pk, user.username, hard_lock, expiry(model, timeout, now))
+
+    def _covered(self, model, pk, user=None):
+        # Whether a lock on an ancestor or a descendant of this object 
+        # applies to ``user``, or without ``user``, whether any of them are
+        # locked. This can't be atomic with locking the object itself.
+        key = force_unicode(pk)
+        locks = self.get_ancestor_locks(model, [pk])[key] + self.get_descendant_locks(model, [pk])[key]
+        for lock in locks:
+            if user is None and lock.is_active or user is not None and lock.applies_to(user):
+                return True
+        return False
+
+    def acquire(self, model, pk, user, hard_lock=False, timeout=None):
+        if self._covered(model, pk, user):
+            return False
+        lock = self._new_lock(model, user, hard_lock, timeout)
+        key = self._key(model, pk)
+        if not self.cache.add(key, self._dump(lock), lock.seconds_remaining + 1):
+            current = self.get(model, pk)
+            if current.applies_to(user):
+                return False
+            # Renewing our own lock. (The cache API doesn't have
+            # compare-and-set, so this can only be as atomic as ``add``.)
+            self.cache.set(key, self._dump(lock), lock.seconds_remaining + 1)
+        self._update_index(model, pk, lock.expires_at)
+        return True
+
+    def _claim(self, model, pk, user, hard_lock=False, timeout=None):
+        # expired locks have disappeared from the cache, 
+        # so ``add`` only succeeds if nobody holds the lock
+        if self._covered(model, pk):
+            return False
+        lock = self._new_lock(model, user, hard_lock, timeout)
+        if self.cache.add(self._key(model, pk), self._dump(lock), lock.seconds_remaining + 1):
+            self._update_index(model, pk, lock.expires_at)
+            return True
+        return False
+
+    def renew(self, model, pk, user, timeout=None):
+        current = self.get(model, pk)
+        if not current.is_active or current.locked_by_id != user.pk:
+            return False
+        current.locked_at = datetime.datetime.today()
+        current.expires_at = expiry(model, timeout, current.locked_at)
+        self._set(model, pk, current)
+        return True
+
+    def release(self, model, pk, user=None):
+        current = self.get(model, pk)
+        if current.locked_at is None:
+            return False
+        if user is not None and current.locked_by_id != user.pk:
+            return False
+        self._delete(model, pk)
+        return True
+
+    def get(self, model, pk):
+        value = self.cache.get(self._key(model, pk))
+        if value is None:
+            return Lock()
+        else:
+            return Lock(*value)
+
+    def get_many(self, model, pks):
+        keys = dict((self._key(model, pk), force_unicode(pk)) for pk in pks)
+        locks = dict((pk, Lock()) for pk in keys.values())
+        for key, value in self.cache.get_many(keys.keys()).items():
+            locks[keys[key]] = Lock(*value)
+        return locks
+
+    def lock(self, queryset, user, hard_lock=False, timeout=None):
+        pks = queryset.values_list('pk', flat=True)
+        return len([pk for pk in pks if self.acquire(queryset.model, pk, user, hard_lock, timeout)])
+
+    def unlock(self, queryset, user=None):
+        pks = queryset.values_list('pk', flat=True)
+        return len([pk for pk in pks if self.release(queryset.model, pk, user)])
+
+    def _locked_q(self, model):
+        q = Q(pk__in=self._locked_pks(model))
+        for prefix, ancestor in lock_ancestors(model):
+            q |= Q(**{prefix + 'pk__in': self._locked_pks(ancestor)})
+        return q
+
+    def locked(self, queryset):
+        return queryset.filter(self._locked_q(queryset.model))
+
+    def held_by(self, queryset, user):
+        return queryset.filter(pk__in=self._locked_pks(queryset.model, user))
+
+    def unlocked(self, queryset):
+        # One ``exclude`` per model, on the foreign key itself (``article__in``,
+        # not ``article__pk__in``), so Django keeps objects without a parent.
+        queryset = queryset.exclude(pk__in=self._locked_pks(queryset.model))
+        for prefix, ancestor in lock_ancestors(queryset.model):
+            queryset = queryset.exclude(**{prefix + 'in': self._locked_pks(ancestor)})
+        return queryset
+
+    def sweep(self, model, batch_size=1000):
+        # expired locks disappear from the cache by themselves,
+        # but we can still tidy up the index
+        self._rebuild_index(model)
+        self._update_index(model, None, None)
+        return 0
+
+    def load(self, instance):
+        self._fill(instance, self.get(type(instance), instance.pk))
+
+    def load_many(self, instances):
+        if instances:
+            locks = self.get_many(type(instances[0]), [instance.pk for instance in instances])
+            for instance in instances:
+                self._fill(instance, locks[force_unicode(instance.pk)])
+
+    def _fill(self, instance, lock):
+        instance._locked_at = lock.locked_at
+        instance._locked_by_id = lock.locked_by_id
+        instance._hard_lock = lock.hard_lock
+        instance._lock_expires_at = lock.expires_at
+        # don't hang on to a user object we might have fetched earlier
+        cache_name = instance._meta.get_field('_locked_by').get_cache_name()
+        if hasattr(instance, cache_name):
+            delattr(instance, cache_name)
+
+    def save(self, instance):
+        model = type(instance)
+        if instance._locked_at is None:
+            self._delete(model, instance.pk)
+        else:
+            user = instance._locked_by
+            self._set(model, instance.pk, Lock(instance._locked_at, user.pk, 
+                user.username, instance._hard_lock, instance._lock_expires_at))
+
+_backend = None
+
+def get_backend():
+    """ Returns the lock storage backend configured in ``LOCK_BACKEND``. """
+    global _backend
+    if _backend is None:
+        module, attr = LOCK_BACKEND.rsplit('.', 1)
+        try:
+            backend = getattr(import_module(module), attr)
+        except (ImportError, AttributeError) as e:
+            raise ImproperlyConfigured("Could not load lock backend `%s`: %s" % (LOCK_BACKEND, e))
+        _backend = backend()
+    return _backend
+
+def invalidate_lock_status(sender, pk, **kwargs):
+    get_backend().invalidate(sender, [pk])
+
+signals.lock_acquired.connect(invalidate_lock_status)
+signals.lock_released.connect(invalidate_lock_status)
@@ -1,15 +1,54 @@
 # encoding: utf-8
 
+import time
+from functools import wraps
+
 from django.http import HttpResponse
-from django.contrib.contenttypes.models import ContentType
 
-from locking.models import LockableModel
-from locking import logger
+from locking.registry import lockable_models
+from locking.metrics import get_collector
+from locking import logger, LOCK_PERMISSION_CACHE_TIMEOUT
+
+def _permission_cache(request):
+    # the permissions we remembered in this user's session, if any
+    session = getattr(request, 'session', None)
+    if session is not None:
+        cached = session.get('locking_permissions')
+        if cached and cached['user'] == request.user.pk and cached['expires'] > time.time():
+            return cached
+    return {
+        'user': request.user.pk,
+        'expires': time.time() + LOCK_PERMISSION_CACHE_TIMEOUT,
+        'permissions': {},
+        }
+
+def may_change(request, app, model):
+    """
+    Whether the user behind ``request`` has permission to change ``model``.
+    Lock requests come in often, so we remember the answer for the rest of
+    the request and, for ``LOCK_PERMISSION_CACHE_TIMEOUT`` seconds, in the
+    user's session. Anonymous users and superusers don't need any queries.
+    """
+    user = request.user
+    if not user.is_authenticated() or not user.is_active:
+        return False
+    if user.is_superuser:
+        return True
+
+    if not hasattr(request, '_locking_permissions'):
+        request._locking_permissions = _permission_cache(request)
+    cached = request._locking_permissions
+    perm = '%s.change_%s' % (app, model)
+    if perm not in cached['permissions']:
+        cached['permissions'][perm] = user.has_perm(perm)
+        if getattr(request, 'session', None) is not None:
+            request.session['locking_permissions'] = cached
+    return cached['permissions'][perm]
 
 def user_may_change_model(fn):
+    @wraps(fn)
     def view(request, app, model, *vargs, **kwargs):
-        may_change = '%s.change_%s' % (app, model)
-        if not request.user.has_perm(may_change):
+        if not may_change(request, app, model):
             return HttpResponse(status=401)
         else:
             return fn(request, app, model, *vargs, **kwargs)
@@ -17,26 +56,37 @@ def user_may_change_model(fn):
     return view
 
 def is_lockable(fn):
+    # goes before ``user_may_change_model``, so made-up models don't
+    # end up in the permission cache in people's sessions
+    @wraps(fn)
     def view(request, app, model, *vargs, **kwargs):
-        try:
-            cls = ContentType.objects.get(app_label=app, model=model).model_class()
-            if issubclass(cls, LockableModel):
-                lockable = True
-            else:
-                lockable = False
-        except ContentType.DoesNotExist:
-            lockable = False
-            
-        if lockable:
+        if (app, model) in lockable_models:
             return fn(request, app, model, *vargs, **kwargs)
         else:
             return HttpResponse(status=404)
     return view
 
 def log(view):
+    @wraps(view)
     def decorated_view(*vargs, **kwargs):
         response = view(*vargs, **kwargs)
-        logger.debug("Sending a request: \n\t%s" % (response.content))
+        logger.debug("Sending a request: \n\t%s", response.content)
         return response
     
-    return decorated_view
\ No newline at end of file
+    return decorated_view
+
+def timed(view):
+    """ Records the response time of a view in the ``locking_view_seconds``
+    histogram, labeled with the view and (if applicable) the model. """
+    @wraps(view)
+    def decorated_view(request, *vargs, **kwargs):
+        start = time.time()
+        response = view(request, *vargs, **kwargs)
+        labels = {'view': view.__name__}
+        # only label lockable models, or every made-up url adds a time series
+        if (kwargs.get('app'), kwargs.get('model')) in lockable_models:
+            labels['model'] = '%s.%s' % (kwargs['app'], kwargs['model'])
+        get_collector().observe('locking_view_seconds', labels, time.time() - start)
+        return response
+
+    return decorated_view
@@ -0,0 +1,155 @@
+# encoding: utf-8
+
+import atexit
+import os
+import threading
+import time
+import Queue
+from datetime import datetime
+
+from django.db import connections, router, transaction
+from django.db.models import AutoField
+from django.utils.encoding import force_unicode
+
+from locking import LOCK_HISTORY_BATCH_SIZE, LOCK_HISTORY_FLUSH_INTERVAL, LOCK_HISTORY_QUEUE_SIZE
+from locking import logger, metrics, signals
+
+"""
+Keeps a history of lock events (``locking.models.LockEvent``), so you can
+find out who held what when, and how often people ran into each other's
+locks. Turn it on with the ``LOCK_HISTORY`` setting.
+
+Writing a row on every lock would double the amount of writes, and make
+the lock views wait for them. Instead, events go into a bounded queue
+in memory, and a background thread inserts them in batches: as soon as
+``LOCK_HISTORY_BATCH_SIZE`` events are waiting, or otherwise every
+``LOCK_HISTORY_FLUSH_INTERVAL`` seconds. Recording an event never blocks.
+When ``LOCK_HISTORY_QUEUE_SIZE`` events are waiting already (e.g. because
+the database is down), new events are dropped and counted in the
+``locking_history_dropped_total`` metric. Events still in the queue
+when a process exits are flushed on the way out, but a process that gets
+killed loses them.
+
+Renewals, like the heartbeat of an open edit page, aren't recorded.
+"""
+
+class History(object):
+    def __init__(self, batch_size=LOCK_HISTORY_BATCH_SIZE,
+        flush_interval=LOCK_HISTORY_FLUSH_INTERVAL, queue_size=LOCK_HISTORY_QUEUE_SIZE,
+        background=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(queue_size)
+        self.background = background
+        self._lock = threading.Lock()
+        # the process our writer thread runs in, which changes when we fork
+        self._pid = None
+
+    def record(self, model, pk, action, user=None):
+        """ Queues up a lock event. Returns False if it had to be dropped. """
+        label = metrics.model_label(model)
+        if user is None:
+            user_id, username = None, ''
+        else:
+            user_id, username = user.pk, user.username
+        event = (label, force_unicode(pk), action, user_id, username, datetime.today())
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            metrics.count('history_dropped', label)
+            return False
+        if self.background and self._pid != os.getpid():
+            self._start()
+        return True
+
+    def flush(self):
+        """ Writes out every event that's waiting, in the calling thread. """
+        while True:
+            events = self._take(self.batch_size)
+            if not events:
+                break
+            self._write(events)
+
+    def _take(self, n, timeout=None):
+        # up to ``n`` events, waiting at most ``timeout`` seconds for them
+        events = []
+        deadline = timeout and time.time() + timeout
+        while len(events) < n:
+            try:
+                if deadline:
+                    events.append(self.queue.get(True, max(deadline - time.time(), 0)))
+                else:
+                    events.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return events
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            thread = threading.Thread(target=self._run, name='locking-history')
+            thread.daemon = True
+            thread.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            # wait for a first event, then give others until the
+            # flush interval is up to join it in the same batch
+            events = [self.queue.get()]
+            events.extend(self._take(self.batch_size - 1, self.flush_interval))
+            self._write(events)
+
+    def _write(self, events):
+        from locking.models import LockEvent
+        try:
+            _insert(LockEvent, [LockEvent(model=model, object_id=pk, action=action,
+                user_id=user_id, username=username, at=at)
+                for model, pk, action, user_id, username, at in events])
+        except Exception:
+            # nothing to report the error to but the log
+            logger.exception("Could not write %s lock events", len(events))
+            for model, pk, action, user_id, username, at in events:
+                metrics.count('history_dropped', model)
+
+def _insert(model, objects):
+    # Django 1.3 has no ``bulk_create``, so this is a single ``executemany``
+    using = router.db_for_write(model)
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields if not isinstance(field, AutoField)]
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        qn(model._meta.db_table),
+        ", ".join(qn(field.column) for field in fields),
+        ", ".join(["%s"] * len(fields)),
+        )
+    params = [[field.get_db_prep_save(getattr(obj, field.attname), connection=connection)
+        for field in fields] for obj in objects]
+    connection.cursor().executemany(sql, params)
+    transaction.commit_unless_managed(using=using)
+
+history = History()
+
+def record_acquired(sender, pk, user, **kwargs):
+    history.record(sender, pk, 'acquired', user)
+
+def record_released(sender, pk, user, **kwargs):
+    history.record(sender, pk, 'released', user)
+
+def record_contended(sender, pk, user, **kwargs):
+    history.record(sender, pk, 'contended', user)
+
+def flush():
+    history.flush()
+
+def connect():
+    """ Starts recording lock events. ``locking.models`` calls this
+    when ``LOCK_HISTORY`` is on. """
+    signals.lock_acquired.connect(record_acquired)
+    signals.lock_released.connect(record_released)
+    signals.lock_contended.connect(record_contended)
+    atexit.register(flush)
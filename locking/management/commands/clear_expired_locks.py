@@ -0,0 +1,31 @@
+# encoding: utf-8
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from locking.registry import lockable_models
+from locking import utils
+
+class Command(BaseCommand):
+    args = "[app.model ...]"
+    help = "Clears out expired locks, on the given lockable models or on all of them."
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help="How many locks to clear in a single query."),
+        )
+
+    def handle(self, *labels, **options):
+        models = []
+        for label in labels:
+            try:
+                app, model = label.lower().split('.')
+            except ValueError:
+                raise CommandError("Expected an app.model label, got `%s`." % label)
+            if (app, model) not in lockable_models:
+                raise CommandError("`%s` is not a lockable model." % label)
+            models.append(lockable_models.get(app, model))
+
+        cleared = utils.clear_expired_locks(models or None, options['batch_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write("Cleared %s expired locks.\n" % cleared)
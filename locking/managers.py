@@ -1,25 +1,160 @@
-from django.db.models import Q, Manager
-from locking import LOCK_TIMEOUT
-import datetime
+from django.db.models import Manager
+from django.db.models.query import QuerySet
+from django.utils.encoding import force_unicode
+from locking.backends import get_backend, concrete_model
+from locking import metrics, signals
 
 """
     LOCKED
-            if (datetime.today() - self.locked_at).seconds < LOCK_TIMEOUT:
+            if self.lock_expires_at > datetime.today():
             
             
-            self.locked_at < (NOW - TIMEOUT)
+            self.lock_expires_at > NOW
+
+    The actual filtering is up to the lock backend, see ``locking.backends``.
 """
 
-def point_of_timeout():
-    delta = datetime.timedelta(seconds=LOCK_TIMEOUT)
-    return datetime.datetime.now() - delta
+class LockableQuerySet(QuerySet):
+    def __init__(self, *vargs, **kwargs):
+        super(LockableQuerySet, self).__init__(*vargs, **kwargs)
+        self._prefetch_locks = False
+
+    def _clone(self, *vargs, **kwargs):
+        clone = super(LockableQuerySet, self)._clone(*vargs, **kwargs)
+        clone._prefetch_locks = self._prefetch_locks
+        return clone
+
+    def prefetch_locks(self):
+        """
+        Returns a queryset that fetches the lock on its objects, the users
+        holding them and the locks on their ancestors, in bulk. Looping over
+        the objects and asking for e.g. ``is_locked``, ``locked_by`` or 
+        ``lock_applies_to`` then doesn't cost any extra queries, however
+        many objects there are.
+        """
+        clone = self._clone()
+        clone._prefetch_locks = True
+        return clone
+
+    def iterator(self):
+        if not self._prefetch_locks:
+            for obj in super(LockableQuerySet, self).iterator():
+                yield obj
+            return
+        
+        objects = list(super(LockableQuerySet, self).iterator())
+        backend = get_backend()
+        backend.load_many(objects)
+        # and the locks on their ancestors, for ``lock_applies_to``
+        ancestor_locks = {}
+        if objects and self.model.lock_parent:
+            ancestor_locks = backend.get_ancestor_locks(self.model, [obj.pk for obj in objects])
+        for obj in objects:
+            obj._state.lock_loaded = True
+            if ancestor_locks:
+                obj._state.ancestor_locks = ancestor_locks[force_unicode(obj.pk)]
+        # one query for all lock holders, instead of one per object
+        user_ids = set(obj._locked_by_id for obj in objects if obj.is_locked)
+        if objects and user_ids:
+            field = objects[0]._meta.get_field('_locked_by')
+            users = field.rel.to._default_manager.in_bulk(list(user_ids))
+            for obj in objects:
+                if obj.is_locked:
+                    setattr(obj, field.get_cache_name(), users.get(obj._locked_by_id))
+        for obj in objects:
+            yield obj
+
+    def held_by(self, user):
+        """ Narrows this queryset down to the rows ``user`` holds an active lock on. """
+        return get_backend().held_by(self, user)
+
+    def lock_for(self, user, hard_lock=False, timeout=None):
+        """
+        Locks every row in this queryset that ``user`` may lock. With the 
+        database backend, that's a single conditional ``UPDATE``. Rows locked
+        by somebody else are left alone. Returns two sets of primary keys (as 
+        unicode): the rows that were locked, and the rows somebody else holds.
+        Locks last ``timeout`` seconds, or the model's ``lock_timeout``.
+        """
+        acquired, held = get_backend().acquire_all(self, user, hard_lock, timeout)
+        metrics.count('acquisitions', self.model, len(acquired))
+        metrics.count('contentions', self.model, len(held))
+        self._send_lock_signals(signals.lock_acquired, acquired, user)
+        self._send_lock_signals(signals.lock_contended, held, user)
+        return acquired, held
+
+    def unlock_for(self, user):
+        """
+        Unlocks every row in this queryset that was locked by ``user``. With the
+        database backend, that's a single ``UPDATE``. Returns two sets of primary 
+        keys (as unicode): the rows that were unlocked, and the rows somebody 
+        else holds an active lock on.
+        """
+        released, held = get_backend().release_all(self, user)
+        metrics.count('unlocks', self.model, len(released))
+        self._send_lock_signals(signals.lock_released, released, user)
+        return released, held
+
+    def unlock(self):
+        """
+        Unlocks every row in this queryset, whoever locked it. Like 
+        ``LockableModel.unlock``, this is meant for manual overrides.
+        Returns the same two sets as ``unlock_for``, though nothing 
+        can hold on to a lock here.
+        """
+        released, held = get_backend().release_all(self)
+        metrics.count('unlocks', self.model, len(released))
+        self._send_lock_signals(signals.lock_released, released, None)
+        return released, held
+
+    def with_lock_state(self):
+        """
+        Adds ``lock_is_active`` (1 or 0) and ``lock_expires_in`` (the seconds
+        left on a lock, negative once it has expired, ``None`` if there's no
+        lock) to every object, computed by the database using its own clock. 
+        You can sort on both with ``order_by``. Only the database backend 
+        supports this.
+        """
+        return get_backend().with_lock_state(self)
+
+    def claim(self, n, user, hard_lock=False, timeout=None):
+        """
+        Locks the first ``n`` rows in this queryset that nobody holds an active
+        lock on, and returns them. Meant for background workers that pull
+        work from the same table: every row gets claimed by only one worker,
+        even when those workers all use the same ``user``. On PostgreSQL and
+        MySQL, this uses ``SELECT ... FOR UPDATE SKIP LOCKED``, so workers 
+        don't wait for each other.
+        """
+        pks = get_backend().claim(self, n, user, hard_lock, timeout)
+        metrics.count('acquisitions', self.model, len(pks))
+        self._send_lock_signals(signals.lock_acquired, pks, user)
+        objects = dict((force_unicode(obj.pk), obj) 
+            for obj in self.model.objects.filter(pk__in=pks))
+        return [objects[pk] for pk in pks if pk in objects]
+
+    def _send_lock_signals(self, signal, pks, user):
+        sender = concrete_model(self.model)
+        for pk in pks:
+            signal.send(sender=sender, pk=pk, user=user)
+
+class LockableManager(Manager):
+    def get_query_set(self):
+        return LockableQuerySet(self.model, using=self._db)
+
+    def held_by(self, user):
+        return self.get_query_set().held_by(user)
+
+    def claim(self, n, user, hard_lock=False, timeout=None):
+        return self.get_query_set().claim(n, user, hard_lock, timeout)
+
+    def with_lock_state(self):
+        return self.get_query_set().with_lock_state()
 
-class LockedManager(Manager):
+class LockedManager(LockableManager):
     def get_query_set(self):
-        timeout = point_of_timeout()
-        return super(LockedManager, self).get_query_set().filter(_locked_at__gt=timeout, _locked_at__isnull=False)
+        return get_backend().locked(super(LockedManager, self).get_query_set())
 
-class UnlockedManager(Manager):
+class UnlockedManager(LockableManager):
     def get_query_set(self):
-        timeout = point_of_timeout()
-        return super(UnlockedManager, self).get_query_set().filter(Q(_locked_at__lte=timeout) | Q(_locked_at__isnull=True))
\ No newline at end of file
+        return get_backend().unlocked(super(UnlockedManager, self).get_query_set())
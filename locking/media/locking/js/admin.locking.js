@@ -14,35 +14,110 @@ function warning () {
     alert(interpolate(gettext("Your lock on this content will expire in a bit less than five minutes. Please save your content and navigate back to this edit page to close the content again for another %s minutes."), minutes))
 }
 
+function lost_lock () {
+    clearInterval(heartbeat_timer)
+    alert(gettext("Your lock on this content has expired, and somebody else has started editing it since. Any changes you save now may overwrite theirs."))
+}
+
+var heartbeat_timer = null
+
+function heartbeat () {
+    // Renew our lock. If it expired in the meantime (e.g. because the 
+    // computer went to sleep), try to get it back.
+    $.ajax({'url': base_url + "/renew/", 'error': function () {
+        $.ajax({'url': base_url + "/lock/", 'error': lost_lock, 'success': function () {
+            // e.g. coming back to a page we'd left, and unlocked, before
+            if (!locked_objects.length) locked_objects.push([app, model, id])
+        }})
+    }})
+}
+
+function wait_for_unlock (version) {
+    // Long-poll the server, which answers as soon as the lock changes 
+    // (or after a while, if it doesn't).
+    $.ajax({
+        'url': base_url + "/wait/",
+        'data': {'version': version},
+        'dataType': 'json',
+        'success': function (lock) {
+            if (lock.applies) {
+                wait_for_unlock(lock.version)
+            } else {
+                var notice = gettext('<p class="is_locked">This content is no longer being edited. <a href="">Reload the page</a> to start editing it.</p>')
+                $("#content-main p.is_locked").replaceWith(notice)
+            }
+        },
+        'error': function () {
+            // don't hammer the server if something's wrong
+            setTimeout(function () { wait_for_unlock(version) }, 30000)
+        }
+    })
+}
+
+// everything this page has locked, and should unlock when it's closed
+var locked_objects = []
+
+function release_locks () {
+    if (!locked_objects.length) return
+    // Beacons get sent even as the page goes away, and don't hold up
+    // navigation. They can't set headers, so the csrf token goes along
+    // with the form data.
+    var url = locking.base_url + "/release/"
+    var data = {
+        'objects': JSON.stringify(locked_objects),
+        'csrfmiddlewaretoken': $("input[name=csrfmiddlewaretoken]").val()
+    }
+    locked_objects = []
+    if (navigator.sendBeacon) {
+        var form = new FormData()
+        $.each(data, function (key, value) { form.append(key, value) })
+        navigator.sendBeacon(url, form)
+    } else {
+        $.ajax({'url': url, 'type': 'POST', 'data': data})
+    }
+}
+
 function locking_mechanism () {
     // locking is pointless when the user is adding a new piece of content
     if (id == 'add') return
     // we disable all input fields pre-emptively, and subsequently check if the content
     // is or is not available for editing
     $(":input").attr("disabled", "disabled")
-    $.getJSON(base_url + "/is_locked/", function(lock, status) {
-        if (lock.applies && status != '404') {
+    // A single request tries to lock the content, and if somebody else 
+    // got there first, tells us who that is.
+    $.ajax({
+        'url': base_url + "/lock/",
+        'dataType': 'json',
+        'success': function (lock) {
+            $(":input").removeAttr("disabled")
+            if (locking.renewal_interval) {
+                // Keep renewing a short-lived lock for as long as the page is open.
+                // A crashed browser stops renewing, so its lock expires soon after.
+                heartbeat_timer = setInterval(heartbeat, 1000*locking.renewal_interval)
+            } else {
+                // We give users a warning that their lock is about to expire,  
+                // five minutes before it actually does.
+                setTimeout(warning, 1000*(lock.seconds_remaining-300))
+            }
+            locked_objects.push([app, model, id])
+        },
+        'error': function (xhr) {
+            // anything but a 403 means this content can't be locked at all
+            if (xhr.status != 403) return
+            var lock = $.parseJSON(xhr.responseText)
             var notice = interpolate(gettext('<p class="is_locked">This content is currently being edited by <em>%(for_user)s</em>. You can read it but not edit it.</p>'), lock, true)
             $("#content-main").prepend(notice)
-        } else {
-            $(":input").removeAttr("disabled")
-            $.get(base_url + "/lock/") 
-            $(window).unload(function(){
-                // We have to assure that our unlock request actually gets
-                // through before the user leaves the page, so it shouldn't
-                // run asynchronously.
-                $.ajax({'url': base_url + "/unlock/", 'async': false})
-            })
+            if (locking.poll_timeout) wait_for_unlock(lock.version)
         }
     })
-    
-    // We give users a warning that their lock is about to expire,  
-    // five minutes before it actually does.
-    setTimeout(1000*(locking.timeout-300), warning)
 }
 
 $(document).ready(function(){
     if ($("body").hasClass("change-form")) {
             locking_mechanism()
     }
-})
\ No newline at end of file
+})
+
+// pagehide is the last event browsers reliably fire when leaving a page,
+// unload is for those that don't know about it
+$(window).bind('pagehide unload', release_locks)
\ No newline at end of file
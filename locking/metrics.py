@@ -0,0 +1,156 @@
+# encoding: utf-8
+
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+from locking import LOCK_METRICS
+from locking.backends import concrete_model
+
+"""
+Counters and latency histograms for lock operations. Which collector
+receives them is up to the ``LOCK_METRICS`` setting; by default, they're
+thrown away. ``MemoryCollector`` keeps them in memory (per process) and
+renders them in the Prometheus text exposition format, which is what the
+``metrics/`` view serves.
+
+Counters:
+
+* ``locking_acquisitions_total``: locks that were acquired
+* ``locking_contentions_total``: lock attempts that failed because somebody
+  else held the lock (the 403s of the lock view)
+* ``locking_renewals_total``: heartbeats that renewed a lock
+* ``locking_expirations_total``: heartbeats that found their own lock had 
+  expired (the cache backend forgets expired locks altogether, so with
+  that backend, these go uncounted)
+* ``locking_swept_total``: expired locks cleared out by ``clear_expired_locks``
+* ``locking_unlocks_total``: locks that were released
+* ``locking_history_dropped_total``: lock events that didn't make it into
+  the lock history (see ``locking.history``)
+
+Histograms:
+
+* ``locking_view_seconds``: response time of the lock views
+"""
+
+def model_label(model):
+    meta = concrete_model(model)._meta
+    return '%s.%s' % (meta.app_label, meta.module_name)
+
+class BaseCollector(object):
+    def increment(self, name, labels, amount=1):
+        raise NotImplementedError
+
+    def observe(self, name, labels, value):
+        raise NotImplementedError
+
+    def render(self):
+        """ Returns all metrics in a text exposition format. """
+        raise NotImplementedError
+
+class NullCollector(BaseCollector):
+    """ Doesn't collect anything. """
+
+    def increment(self, name, labels, amount=1):
+        pass
+
+    def observe(self, name, labels, value):
+        pass
+
+    def render(self):
+        return ''
+
+class MemoryCollector(BaseCollector):
+    """ Keeps counters and histograms in memory, for as long as the process lives. """
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        # name and labels -> ([count per bucket], sum, count)
+        self.histograms = {}
+
+    def _key(self, name, labels):
+        return (name, tuple(sorted(labels.items())))
+
+    def increment(self, name, labels, amount=1):
+        key = self._key(name, labels)
+        self._lock.acquire()
+        try:
+            self.counters[key] = self.counters.get(key, 0) + amount
+        finally:
+            self._lock.release()
+
+    def observe(self, name, labels, value):
+        key = self._key(name, labels)
+        self._lock.acquire()
+        try:
+            buckets, total, count = self.histograms.get(key, ([0] * len(self.buckets), 0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    buckets[i] += 1
+            self.histograms[key] = (buckets, total + value, count + 1)
+        finally:
+            self._lock.release()
+
+    def _format(self, name, labels, value):
+        if labels:
+            labels = ",".join('%s="%s"' % label for label in labels)
+            return '%s{%s} %s' % (name, labels, value)
+        else:
+            return '%s %s' % (name, value)
+
+    def render(self):
+        self._lock.acquire()
+        try:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(buckets), total, count))
+                for key, (buckets, total, count) in self.histograms.items())
+        finally:
+            self._lock.release()
+
+        lines = []
+        typed = set()
+        for (name, labels), value in counters:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append(self._format(name, labels, value))
+        for (name, labels), (buckets, total, count) in histograms:
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for bound, value in zip(self.buckets, buckets):
+                bucket_labels = labels + (('le', bound), )
+                lines.append(self._format(name + '_bucket', bucket_labels, value))
+            lines.append(self._format(name + '_bucket', labels + (('le', '+Inf'), ), count))
+            lines.append(self._format(name + '_sum', labels, total))
+            lines.append(self._format(name + '_count', labels, count))
+        return "\n".join(lines) + "\n"
+
+_collector = None
+
+def get_collector():
+    """ Returns the metrics collector configured in ``LOCK_METRICS``. """
+    global _collector
+    if _collector is None:
+        if LOCK_METRICS:
+            module, attr = LOCK_METRICS.rsplit('.', 1)
+            try:
+                collector = getattr(import_module(module), attr)
+            except (ImportError, AttributeError) as e:
+                raise ImproperlyConfigured("Could not load metrics collector `%s`: %s" % (LOCK_METRICS, e))
+        else:
+            collector = NullCollector
+        _collector = collector()
+    return _collector
+
+def count(name, model, amount=1):
+    """ Increments the ``locking_<name>_total`` counter for a model
+    (either a model class or an ``app.model`` label). """
+    if not amount:
+        return
+    if not isinstance(model, basestring):
+        model = model_label(model)
+    get_collector().increment('locking_%s_total' % name, {'model': model}, amount)
@@ -5,8 +5,13 @@ from datetime import datetime
 from django.db import models
 from django.conf import settings
 from django.contrib.auth import models as auth
+from django.contrib.sessions.models import Session
+from django.utils.encoding import force_unicode
 
-from locking import LOCK_TIMEOUT, logger
+from locking import LOCK_TIMEOUT, LOCK_RELEASE_ON_LOGOUT, LOCK_SESSION_SCAN_LIMIT, LOCK_HISTORY, logger
+from locking.registry import lockable_models
+from locking.backends import get_backend, concrete_model, expiry
+from locking import metrics, signals, utils
 import managers
 
 class ObjectLockedError(IOError):
@@ -14,15 +19,24 @@ class ObjectLockedError(IOError):
 
 class LockableModel(models.Model):
     """ LockableModel comes with three managers: ``objects``, ``locked`` and 
-    ``unlocked``. They do what you'd expect them to. """
+    ``unlocked``. They do what you'd expect them to. 
+    
+    Locks last ``lock_timeout`` seconds, which defaults to the ``LOCK_TIMEOUT``
+    setting. Override it on your model to give its locks a different duration. 
+    
+    Set ``lock_parent`` to the name of a foreign key to another lockable model,
+    and a lock on the object it points to covers this object as well. """
 
-    objects = managers.Manager()
+    objects = managers.LockableManager()
     locked = managers.LockedManager()
     unlocked = managers.UnlockedManager()
 
     def __init__(self, *vargs, **kwargs):
         super(LockableModel, self).__init__(*vargs, **kwargs)
         self._state.locking = False
+        self._state.lock_loaded = False
+        # the locks on our ancestors, if ``prefetch_locks`` fetched them
+        self._state.ancestor_locks = None
 
     class Meta:
         abstract = True
@@ -36,6 +50,13 @@ class LockableModel(models.Model):
         null=True,
         editable=False)
     _hard_lock = models.BooleanField(db_column='hard_lock', default=False, editable=False)
+    _lock_expires_at = models.DateTimeField(db_column='lock_expires_at', 
+        null=True,
+        db_index=True,
+        editable=False)
+    
+    lock_timeout = LOCK_TIMEOUT
+    lock_parent = None
     
     # We don't want end-developers to manipulate database fields directly, 
     # hence we're putting these behind simple getters.
@@ -43,14 +64,32 @@ class LockableModel(models.Model):
     @property
     def locked_at(self):
         """A simple ``DateTimeField`` that is the heart of the locking mechanism. Read-only."""
+        self._load_lock()
         return self._locked_at
     
     @property
     def locked_by(self):
         """``locked_by`` is a foreign key to ``auth.User``. The ``related_name`` on the 
         User object is ``working_on_%(class)s``. Read-only."""
+        self._load_lock()
         return self._locked_by
     
+    @property
+    def lock_expires_at(self):
+        """When the current lock expires, as stored when it was acquired or renewed. Read-only."""
+        self._load_lock()
+        return self._lock_expires_at
+    
+    def _load_lock(self):
+        # With the database backend, the lock fields come with the row, but
+        # other backends store them elsewhere. We fetch them lazily, and only
+        # once, so e.g. lists of objects don't cost a lookup per object
+        # unless you actually ask for their lock.
+        if not self._state.lock_loaded:
+            self._state.lock_loaded = True
+            if self.pk is not None:
+                get_backend().load(self)
+    
     @property
     def lock_type(self):
         """ Returns the type of lock that is currently active. Either
@@ -67,10 +106,10 @@ class LockableModel(models.Model):
     def is_locked(self):
         """
         A read-only property that returns True or False.
-        Works by calculating if the last lock (self.locked_at) has timed out or not.
+        Works by checking if the last lock (self.lock_expires_at) has expired or not.
         """
-        if isinstance(self.locked_at, datetime):
-            if (datetime.today() - self.locked_at).seconds < LOCK_TIMEOUT:
+        if isinstance(self.lock_expires_at, datetime):
+            if self.lock_seconds_remaining > 0:
                 return True
             else:
                 return False
@@ -87,10 +126,14 @@ class LockableModel(models.Model):
         
         If you want to extend a lock beyond its current expiry date, initiate a new
         lock using the ``lock_for`` method.
+        
+        To sort or filter on this, see ``with_lock_state`` on the managers.
         """
-        return LOCK_TIMEOUT - (datetime.today() - self.locked_at).seconds
+        remaining = self.lock_expires_at - datetime.today()
+        # not just ``remaining.seconds``, which leaves out whole days
+        return remaining.days * 86400 + remaining.seconds
     
-    def lock_for(self, user, hard_lock=False):
+    def lock_for(self, user, hard_lock=False, atomic=False, timeout=None):
         """
         Together with ``unlock_for`` this is probably the most important method 
         on this model. If applicable to your use-case, you should lock for a specific 
@@ -102,24 +145,55 @@ class LockableModel(models.Model):
         without first unlocking will raise an ``ObjectLockedError``.
         
         Don't use hard locks unless you really need them. See :doc:`design`.
+        
+        By default, the lock only takes effect once you save the object. With
+        ``atomic=True``, the lock is instead acquired right away, through a single
+        conditional ``UPDATE`` that only succeeds if the row is unlocked, its lock
+        has expired or it is already locked by ``user``. That closes the window
+        between checking and saving a lock, in which two users could both
+        acquire it. No save is needed afterwards.
+        
+        The lock lasts ``timeout`` seconds, or if you don't pass one, 
+        ``lock_timeout`` seconds.
         """
-        logger.info("Attempting to initiate a lock for user `%s`" % user)
+        logger.info("Attempting to initiate a lock for user `%s`", user)
 
         if not isinstance(user, auth.User):
             raise ValueError("You should pass a valid auth.User to lock_for.")
         
-        if self.lock_applies_to(user):
+        if atomic:
+            if not get_backend().acquire(self.__class__, self.pk, user, hard_lock, timeout):
+                metrics.count('contentions', self.__class__)
+                signals.lock_contended.send(sender=concrete_model(self.__class__), pk=self.pk, user=user)
+                raise ObjectLockedError("This object is already locked by another user. \
+                    May not override, except through the `unlock` method.")
+            # the lock is already in the database, so there's no save pending
+            # that could trip over our own hard lock
+            self._locked_at = datetime.today()
+            self._locked_by = user
+            self._hard_lock = hard_lock
+            self._lock_expires_at = expiry(self.__class__, timeout, self._locked_at)
+            self._state.lock_loaded = True
+            self.__init_hard_lock = False
+            metrics.count('acquisitions', self.__class__)
+            signals.lock_acquired.send(sender=concrete_model(self.__class__), pk=self.pk, user=user)
+            logger.info("Initiated a %s lock for `%s` at %s", self.lock_type, self.locked_by, self.locked_at)
+        elif self.lock_applies_to(user) or self._descendants_locked_for(user):
+            metrics.count('contentions', self.__class__)
+            signals.lock_contended.send(sender=concrete_model(self.__class__), pk=self.pk, user=user)
             raise ObjectLockedError("This object is already locked by another user. \
                 May not override, except through the `unlock` method.")
         else:
             self._locked_at = datetime.today()
             self._locked_by = user
             self._hard_lock = self.__init_hard_lock = hard_lock
-            date = self.locked_at.strftime("%H:%M:%S")
+            self._lock_expires_at = expiry(self.__class__, timeout, self._locked_at)
+            self._state.lock_loaded = True
             # an administrative toggle, to make it easier for devs to extend `django-locking`
             # and react to locking and unlocking
             self._state.locking = True
-            logger.info("Initiated a %s lock for `%s` at %s" % (self.lock_type, self.locked_by, self.locked_at))     
+            self._state.lock_user = user
+            logger.info("Initiated a %s lock for `%s` at %s", self.lock_type, self.locked_by, self.locked_at)     
 
     def unlock(self):
         """
@@ -127,11 +201,13 @@ class LockableModel(models.Model):
         to do manual lock overrides, even if they haven't initiated these
         locks themselves. Otherwise, use ``unlock_for``.
         """
-        self._locked_at = self._locked_by = None
+        self._locked_at = self._locked_by = self._lock_expires_at = None
+        self._state.lock_loaded = True
         # an administrative toggle, to make it easier for devs to extend `django-locking`
         # and react to locking and unlocking
         self._state.locking = True
-        logger.info("Disengaged lock on `%s`" % self)
+        self._state.lock_user = None
+        logger.info("Disengaged lock on `%s`", self)
     
     def unlock_for(self, user):
         """
@@ -142,11 +218,12 @@ class LockableModel(models.Model):
         Will raise a ObjectLockedError exception when the current user isn't authorized to
         unlock the object.
         """
-        logger.info("Attempting to open up a lock on `%s` by user `%s`" % (self, user))
+        logger.info("Attempting to open up a lock on `%s` by user `%s`", self, user)
     
         # refactor: should raise exceptions instead
         if self.is_locked_by(user):
             self.unlock()
+            self._state.lock_user = user
         else:
             raise ObjectLockedError("Trying to unlock for another user than the one who initiated the currently active lock. This is not allowed. You may want to try a manual override through the `unlock` method instead.")
     
@@ -156,15 +233,38 @@ class LockableModel(models.Model):
         ``lock_applies_to`` is used to ascertain whether a user is allowed
         to edit a locked object.
         """
-        logger.info("Checking if the lock on `%s` applies to user `%s`" % (self, user))
+        logger.info("Checking if the lock on `%s` applies to user `%s`", self, user)
         # a lock does not apply to the person who initiated the lock
-        if self.is_locked and self.locked_by != user:
+        # comparing ids, so we don't need to fetch the lock holder
+        if self.is_locked and self._locked_by_id != user.pk:
             logger.info("Lock applies.")
             return True
-        else:
-            logger.info("Lock does not apply.")
-            return False
+        # nor does the lock on a parent, which covers its children without
+        # them having to be locked themselves
+        for lock in self._ancestor_locks():
+            if lock.applies_to(user):
+                logger.info("Lock on an ancestor applies.")
+                return True
+        logger.info("Lock does not apply.")
+        return False
     
+    def _ancestor_locks(self):
+        # a single query for the keys of all of our ancestors, rather
+        # than fetching them one by one, unless they've been prefetched
+        if not self.lock_parent or self.pk is None:
+            return []
+        if self._state.ancestor_locks is not None:
+            return self._state.ancestor_locks
+        locks = get_backend().get_ancestor_locks(self.__class__, [self.pk])
+        return locks[force_unicode(self.pk)]
+
+    def _descendants_locked_for(self, user):
+        # whether our lock would cover objects somebody else has locked
+        if self.pk is None:
+            return False
+        locks = get_backend().get_descendant_locks(self.__class__, [self.pk])
+        return any(lock.applies_to(user) for lock in locks[force_unicode(self.pk)])
+
     def is_locked_by(self, user):
         """
         Returns True or False. Can be used to test whether this object is locked by
@@ -174,6 +274,31 @@ class LockableModel(models.Model):
         """
         return user == self.locked_by
     
+    def save_lock(self):
+        """
+        Writes the lock columns, and only the lock columns, to the database.
+        Use this instead of ``save`` after ``lock_for``, ``unlock`` or
+        ``unlock_for`` if you haven't changed anything else on the object:
+        it avoids rewriting (potentially large) content columns just to
+        persist a lock.
+        """
+        get_backend().save(self)
+        self.__init_hard_lock = False
+        if self._state.locking:
+            self._send_lock_signal()
+        self._state.locking = False
+    
+    def _send_lock_signal(self):
+        # only now that the lock (or its release) has been stored 
+        # do we count it, and let others know
+        if self._locked_at is None:
+            metrics.count('unlocks', self.__class__)
+            signal = signals.lock_released
+        else:
+            metrics.count('acquisitions', self.__class__)
+            signal = signals.lock_acquired
+        signal.send(sender=concrete_model(self.__class__), pk=self.pk, user=self._state.lock_user)
+    
     def save(self, *vargs, **kwargs):
         if self.lock_type == 'hard' and not self.__init_hard_lock:
             raise ObjectLockedError("""There is currently a hard lock in place. You may not save.
@@ -183,4 +308,97 @@ class LockableModel(models.Model):
         self.__init_hard_lock = False
         
         super(LockableModel, self).save(*vargs, **kwargs)
-        self._state.locking = False
\ No newline at end of file
+        # backends that don't keep locks in the model's own table
+        # need to store a lock or unlock separately
+        backend = get_backend()
+        if self._state.locking and not backend.persists_with_model:
+            backend.save(self)
+        if self._state.locking:
+            self._send_lock_signal()
+        self._state.locking = False
+
+class LockEvent(models.Model):
+    """ A lock that was acquired, released or contended, as recorded by 
+    ``locking.history``. Rows are only ever inserted. """
+    ACTIONS = (
+        ('acquired', 'acquired'),
+        ('released', 'released'),
+        ('contended', 'contended'),
+        )
+
+    # ``app_label.model``, as in the lock metrics
+    model = models.CharField(max_length=100)
+    object_id = models.CharField(max_length=255)
+    action = models.CharField(max_length=10, choices=ACTIONS)
+    # not a foreign key: the history outlives the users in it
+    user_id = models.IntegerField(null=True)
+    username = models.CharField(max_length=30, blank=True)
+    at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        ordering = ('at', )
+
+def register_lockable_model(sender, **kwargs):
+    # keeps ``locking.registry.lockable_models`` up to date, so nobody
+    # has to scan all content types to find out what's lockable
+    # deferred models (as created by ``only`` and ``defer``) are stand-ins
+    # for the real thing and shouldn't be registered
+    if issubclass(sender, LockableModel) and not sender._meta.abstract \
+        and not getattr(sender, '_deferred', False):
+        lockable_models.register(sender)
+
+models.signals.class_prepared.connect(register_lockable_model)
+
+def release_locks_on_logout(sender, request, user, **kwargs):
+    if user is None:
+        return
+    # the session we're logging out of is still around at this point
+    session_key = getattr(getattr(request, 'session', None), 'session_key', None)
+    if not utils.locks_held_by(user) or _has_live_session(user.pk, exclude=session_key):
+        return
+    released = utils.release_locks_held_by(user)
+    logger.info("Released %s locks held by `%s`, who logged out", released, user)
+
+def release_locks_on_session_expiry(sender, instance, **kwargs):
+    # Expired sessions are only ever deleted by the ``cleanup`` command.
+    # (Sessions that end because somebody logs out are covered above.)
+    if instance.expire_date > datetime.now():
+        return
+    user_id = instance.get_decoded().get('_auth_user_id')
+    try:
+        user = auth.User.objects.get(pk=user_id)
+    except auth.User.DoesNotExist:
+        return
+    if not utils.locks_held_by(user) or _has_live_session(user_id):
+        return
+    released = utils.release_locks_held_by(user)
+    logger.info("Released %s locks held by `%s`, whose session expired", released, user)
+
+def _has_live_session(user_id, exclude=None):
+    # Somebody who's still logged in elsewhere may be using their locks 
+    # there. Finding that out means decoding live sessions, so we only 
+    # bother for users who hold any locks at all, and look through at most
+    # ``LOCK_SESSION_SCAN_LIMIT`` of them, the most recently used first. 
+    # If that's not enough, we play it safe: the locks will expire anyway.
+    sessions = Session.objects.filter(expire_date__gt=datetime.now()).exclude(session_key=exclude)
+    sessions = sessions.order_by('-expire_date')[:LOCK_SESSION_SCAN_LIMIT + 1]
+    for i, session in enumerate(sessions.iterator()):
+        if i == LOCK_SESSION_SCAN_LIMIT:
+            return True
+        if session.get_decoded().get('_auth_user_id') == user_id:
+            return True
+    return False
+
+if LOCK_RELEASE_ON_LOGOUT:
+    try:
+        from django.contrib.auth.signals import user_logged_out
+    except ImportError:
+        # Django 1.2 doesn't tell us when people log out
+        pass
+    else:
+        user_logged_out.connect(release_locks_on_logout)
+    models.signals.post_delete.connect(release_locks_on_session_expiry, sender=Session)
+
+if LOCK_HISTORY:
+    from locking import history
+    history.connect()
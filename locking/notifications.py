@@ -0,0 +1,67 @@
+# encoding: utf-8
+
+import threading
+
+from django.utils.encoding import force_unicode
+
+from locking.backends import concrete_model
+from locking import signals
+
+"""
+Lets requests wait for the lock on an object to change, which is what the
+long-polling ``wait`` view does. There's a single registry of subscriptions
+per process, fed by the ``lock_acquired`` and ``lock_released`` signals, so
+a thousand viewers of the same object don't mean a thousand database polls.
+
+Lock changes made by other processes don't reach this registry. Waiting
+requests find out about those when they time out and check the lock again.
+"""
+
+class Subscriptions(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    def _key(self, model, pk):
+        meta = concrete_model(model)._meta
+        return (meta.app_label, meta.module_name, force_unicode(pk))
+
+    def subscribe(self, model, pk):
+        """ Returns a ``threading.Event`` that gets set when the lock on
+        this object changes. Don't forget to ``unsubscribe`` afterwards. """
+        event = threading.Event()
+        key = self._key(model, pk)
+        self._lock.acquire()
+        try:
+            self._waiters.setdefault(key, set()).add(event)
+        finally:
+            self._lock.release()
+        return event
+
+    def unsubscribe(self, model, pk, event):
+        key = self._key(model, pk)
+        self._lock.acquire()
+        try:
+            waiters = self._waiters.get(key, set())
+            waiters.discard(event)
+            if not waiters:
+                self._waiters.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def notify(self, model, pk):
+        self._lock.acquire()
+        try:
+            waiters = list(self._waiters.get(self._key(model, pk), ()))
+        finally:
+            self._lock.release()
+        for event in waiters:
+            event.set()
+
+subscriptions = Subscriptions()
+
+def notify_subscribers(sender, pk, **kwargs):
+    subscriptions.notify(sender, pk)
+
+signals.lock_acquired.connect(notify_subscribers)
+signals.lock_released.connect(notify_subscribers)
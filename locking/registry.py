@@ -0,0 +1,46 @@
+# encoding: utf-8
+
+class LockableModelRegistry(object):
+    """
+    Keeps track of every concrete ``LockableModel`` subclass, keyed by
+    app label and model name. Models register themselves as soon as their
+    class is prepared (see ``locking.models``), so looking up a lockable
+    model never requires a trip to the ``ContentType`` table.
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._by_app = None
+
+    def register(self, model):
+        key = (model._meta.app_label, model._meta.module_name)
+        self._models[key] = model
+        # the grouped view gets rebuilt on demand
+        self._by_app = None
+
+    def unregister(self, model):
+        key = (model._meta.app_label, model._meta.module_name)
+        self._models.pop(key, None)
+        self._by_app = None
+
+    def get(self, app, model):
+        """ Returns the lockable model class for ``app`` and ``model``,
+        or ``None`` if no such lockable model exists. """
+        return self._models.get((app, model))
+
+    def __contains__(self, key):
+        return key in self._models
+
+    def __iter__(self):
+        return iter(self._models.values())
+
+    def by_app(self):
+        """ Returns a ``{app: {model: class}}`` dictionary of all lockable models. """
+        if self._by_app is None:
+            grouped = dict()
+            for (app, name), model in self._models.items():
+                grouped.setdefault(app, {})[name] = model
+            self._by_app = grouped
+        return self._by_app
+
+lockable_models = LockableModelRegistry()
@@ -0,0 +1,14 @@
+# encoding: utf-8
+
+from django.dispatch import Signal
+
+"""
+Sent whenever a lock is stored or removed, or when somebody tries to lock
+an object somebody else holds. The sender is the (concrete) lockable model, 
+``pk`` the primary key of the object and ``user`` the user the object was 
+(to be) locked or unlocked for (``None`` for manual overrides).
+"""
+
+lock_acquired = Signal(providing_args=['pk', 'user'])
+lock_released = Signal(providing_args=['pk', 'user'])
+lock_contended = Signal(providing_args=['pk', 'user'])
@@ -0,0 +1,145 @@
+# encoding: utf-8
+
+"""
+Benchmarks for the hot paths of ``django-locking``: the model API, the
+ajax views, the lockable model lookup and the ``LockableAdmin`` changelist.
+Run them with ``python manage.py locking_benchmark`` in a project that has
+``locking.tests`` in its ``INSTALLED_APPS``.
+
+Every benchmark reports operations per second, median (p50) and p99 latency
+in milliseconds and the average amount of queries per operation.
+"""
+
+from timeit import default_timer
+
+from django.conf import settings
+from django.db import connection, reset_queries
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+
+from locking import utils, views
+from locking.tests.models import Story
+
+PASSWORD = 'benchmark'
+
+def percentile(timings, percent):
+    # ``timings`` should be sorted
+    index = int(round((len(timings) - 1) * percent / 100.0))
+    return timings[index]
+
+def measure(name, fn, iterations, **params):
+    """ Runs ``fn`` ``iterations`` times and summarizes how long it took
+    and how many queries it needed. """
+    # the database connection only keeps track of queries in debug mode
+    debug = settings.DEBUG
+    settings.DEBUG = True
+    timings = []
+    queries = 0
+    try:
+        for i in range(iterations):
+            reset_queries()
+            start = default_timer()
+            fn()
+            timings.append(default_timer() - start)
+            queries += len(connection.queries)
+    finally:
+        settings.DEBUG = debug
+        reset_queries()
+
+    timings.sort()
+    return {
+        'name': name,
+        'params': params,
+        'iterations': iterations,
+        'ops_per_sec': iterations / sum(timings),
+        'p50_ms': percentile(timings, 50) * 1000,
+        'p99_ms': percentile(timings, 99) * 1000,
+        'queries_per_op': queries / float(iterations),
+        }
+
+def create_users():
+    User.objects.filter(username__startswith='benchmark').delete()
+    user = User.objects.create_superuser('benchmark', 'benchmark@example.com', PASSWORD)
+    alt_user = User.objects.create_user('benchmark-alt', 'benchmark-alt@example.com', PASSWORD)
+    return user, alt_user
+
+def create_stories(count, locked_by=None):
+    """ Creates ``count`` fresh stories, half of them locked by ``locked_by``. """
+    Story.objects.all().delete()
+    stories = []
+    for i in range(count):
+        story = Story(content="Benchmark story %s. " % i * 20)
+        if locked_by and i % 2:
+            story.lock_for(locked_by)
+        story.save()
+        stories.append(story)
+    return stories
+
+def create_content_types(count):
+    """ Makes sure there are (at least) ``count`` content types. """
+    existing = ContentType.objects.count()
+    for i in range(existing, count):
+        ContentType.objects.create(name='benchmark %s' % i,
+            app_label='benchmark', model='benchmark%s' % i)
+
+def bench_model(user, iterations):
+    story = create_stories(1)[0]
+    def lock_unlock():
+        story.lock_for(user)
+        story.save()
+        story.unlock_for(user)
+        story.save()
+    def atomic_lock():
+        story.lock_for(user, atomic=True)
+    def is_locked():
+        Story.objects.get(pk=story.pk).is_locked
+    return [
+        measure('model.lock_for+unlock_for', lock_unlock, iterations),
+        measure('model.lock_for(atomic=True)', atomic_lock, iterations),
+        measure('model.is_locked', is_locked, iterations),
+        ]
+
+def bench_views(user, iterations):
+    story = create_stories(1)[0]
+    client = Client()
+    client.login(username=user.username, password=PASSWORD)
+    args = [story._meta.app_label, story._meta.module_name, story.pk]
+    results = []
+    for view in (views.lock, views.is_locked, views.unlock):
+        url = reverse(view, args=args)
+        results.append(measure('views.%s' % view.__name__,
+            lambda: client.get(url), iterations))
+    return results
+
+def bench_gather_lockable_models(iterations, content_type_counts):
+    results = []
+    for count in content_type_counts:
+        create_content_types(count)
+        results.append(measure('utils.gather_lockable_models',
+            utils.gather_lockable_models, iterations, content_types=count))
+    return results
+
+def bench_changelist(user, alt_user, iterations, row_counts):
+    client = Client()
+    client.login(username=user.username, password=PASSWORD)
+    url = reverse('admin:tests_story_changelist')
+    results = []
+    for count in row_counts:
+        create_stories(count, locked_by=alt_user)
+        results.append(measure('admin.changelist',
+            lambda: client.get(url), iterations, rows=count))
+    return results
+
+def run(iterations=100, row_counts=(10, 100, 1000), content_type_counts=(10, 100, 1000)):
+    """ Runs all benchmarks, and returns a list of results. Expects to be
+    run against a test database: it creates and deletes stories and users. """
+    user, alt_user = create_users()
+    results = []
+    results.extend(bench_model(user, iterations))
+    results.extend(bench_views(user, iterations))
+    results.extend(bench_gather_lockable_models(iterations, content_type_counts))
+    # the changelist is a lot slower than everything else
+    results.extend(bench_changelist(user, alt_user, max(iterations // 10, 1), row_counts))
+    return results
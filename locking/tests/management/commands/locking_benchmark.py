@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+from optparse import make_option
+
+import simplejson
+
+from django.core.management.base import BaseCommand
+from django.test.simple import DjangoTestSuiteRunner
+
+from locking.tests import benchmarks
+
+def comma_separated(value):
+    return tuple(int(number) for number in value.split(','))
+
+class Command(BaseCommand):
+    help = "Benchmarks the lock views, the model API and LockableAdmin, against a test database."
+    option_list = BaseCommand.option_list + (
+        make_option('--iterations', type='int', default=100,
+            help="How often to run every benchmark."),
+        make_option('--rows', default='10,100,1000',
+            help="Comma-separated amounts of stories for the changelist benchmark."),
+        make_option('--content-types', dest='content_types', default='10,100,1000',
+            help="Comma-separated amounts of content types for the model lookup benchmark."),
+        make_option('--output',
+            help="Save the results as JSON to this file."),
+        )
+
+    def handle(self, *args, **options):
+        # never benchmark against a real database
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            results = benchmarks.run(
+                iterations=options['iterations'],
+                row_counts=comma_separated(options['rows']),
+                content_type_counts=comma_separated(options['content_types']),
+                )
+        finally:
+            runner.teardown_databases(old_config)
+
+        for result in results:
+            params = ", ".join("%s=%s" % param for param in result['params'].items())
+            self.stdout.write("%-30s %-18s %10.1f ops/s  p50 %8.2f ms  p99 %8.2f ms  %6.1f queries/op\n" % (
+                result['name'], params, result['ops_per_sec'],
+                result['p50_ms'], result['p99_ms'], result['queries_per_op']))
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, output, indent=2)
+            finally:
+                output.close()
@@ -0,0 +1,69 @@
+# encoding: utf-8
+
+import os
+import tempfile
+from optparse import make_option
+
+import simplejson
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.test.simple import DjangoTestSuiteRunner
+
+from locking.tests import stress
+from locking.tests.management.commands.locking_benchmark import comma_separated
+
+class Command(BaseCommand):
+    help = "Stress tests the lock views with many processes and threads, against a test database."
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', default='1,2,4,8',
+            help="Comma-separated amounts of worker processes to run the stress test with."),
+        make_option('--threads', type='int', default=2,
+            help="How many threads every worker process runs."),
+        make_option('--stories', type='int', default=3,
+            help="How many stories the workers fight over."),
+        make_option('--duration', type='int', default=5,
+            help="How long (in seconds) to run the stress test for, per amount of processes."),
+        make_option('--output',
+            help="Save the results as JSON to this file."),
+        )
+
+    def handle(self, *args, **options):
+        # SQLite test databases live in memory, where other processes can't
+        # get at them, so we put the test database in a file instead
+        database = connections['default'].settings_dict
+        temporary = None
+        if database['ENGINE'].endswith('sqlite3') and \
+            database.get('TEST_NAME') in (None, '', ':memory:'):
+            handle, temporary = tempfile.mkstemp(suffix='.db', prefix='locking-stress-')
+            os.close(handle)
+            database['TEST_NAME'] = temporary
+
+        # never stress test a real database
+        runner = DjangoTestSuiteRunner(verbosity=0, interactive=False)
+        old_config = runner.setup_databases()
+        try:
+            results = stress.run(
+                process_counts=comma_separated(options['processes']),
+                thread_count=options['threads'],
+                story_count=options['stories'],
+                duration=options['duration'],
+                )
+        finally:
+            runner.teardown_databases(old_config)
+            if temporary and os.path.exists(temporary):
+                os.remove(temporary)
+
+        for result in results:
+            self.stdout.write("%3d processes x %d threads %10.1f req/s  403 %5.1f%%  "
+                "p50 %8.2f ms  p99 %8.2f ms  %5d errors  %3d violations\n" % (
+                result['processes'], result['threads'], result['requests_per_sec'],
+                result['refused_rate'] * 100, result['p50_ms'], result['p99_ms'],
+                result['errors'], result['violations']))
+
+        if options['output']:
+            output = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, output, indent=2)
+            finally:
+                output.close()
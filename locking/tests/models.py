@@ -7,6 +7,13 @@ class Story(locking.LockableModel):
     class Meta:
         verbose_name_plural = 'stories'
 
+class Paragraph(locking.LockableModel):
+    # locking a story locks its paragraphs too
+    story = models.ForeignKey(Story, related_name='paragraphs', null=True)
+    content = models.TextField(blank=True)
+    
+    lock_parent = 'story'
+
 class Unlockable(models.Model):
     # this model serves to test that utils.gather_lockable_models
     # actually does what it's supposed to
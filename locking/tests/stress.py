@@ -0,0 +1,180 @@
+# encoding: utf-8
+
+"""
+A stress test for the lock views: many processes, each running a few
+threads, lock, check and unlock a handful of hot stories as fast as they
+can. Run it with ``python manage.py locking_stress`` in a project that has
+``locking.tests`` in its ``INSTALLED_APPS``.
+
+Every thread logs in as a user of its own and loops: pick a story, ``lock``
+it and, if that worked, check it with ``is_locked`` and ``unlock`` it
+again. If the lock was refused, it only calls ``is_locked``.
+
+While a thread holds a lock, ``is_locked`` should say so, and no other
+thread should get a 200 from ``lock`` on that story. Afterwards, the time
+each thread knew it held a lock (from the ``lock`` response until it sent
+the ``unlock``) is compared between threads: any overlap on the same story
+means two users held it at once. Both kinds of violation are reported.
+
+Per amount of processes, this reports requests per second, the share of
+``lock`` requests that got a 403, p50 and p99 latency in milliseconds,
+errors (anything but a 200 or 403, and exceptions, e.g. when SQLite gives
+up waiting for its database lock) and violations.
+"""
+
+import multiprocessing
+import random
+import threading
+from timeit import default_timer
+
+import simplejson
+
+from django.db import connection
+from django.core.urlresolvers import reverse
+from django.test.client import Client
+from django.contrib.auth.models import User
+
+from locking import views
+from locking.tests.models import Story
+from locking.tests.benchmarks import PASSWORD, percentile, create_stories
+
+def create_users(count):
+    User.objects.filter(username__startswith='stress').delete()
+    users = []
+    for i in range(count):
+        username = 'stress-%s' % i
+        users.append(User.objects.create_superuser(username, '%s@example.com' % username, PASSWORD))
+    return users
+
+def urls(story):
+    args = [story._meta.app_label, story._meta.module_name, story.pk]
+    return dict((view.__name__, reverse(view, args=args))
+        for view in (views.lock, views.is_locked, views.unlock))
+
+def new_stats():
+    return {'locks': 0, 'refused': 0, 'errors': 0, 'violations': 0,
+        'latencies': [], 'held': []}
+
+def merge_stats(stats):
+    merged = new_stats()
+    for s in stats:
+        for key, value in s.items():
+            merged[key] += value
+    return merged
+
+def hammer(client, username, stories, duration, stats):
+    """ Locks, checks and unlocks ``stories`` at random for ``duration``
+    seconds, and keeps track of what happened in ``stats``. """
+    def request(view, story):
+        start = default_timer()
+        try:
+            response = client.get(story[view])
+        except Exception:
+            stats['errors'] += 1
+            return None
+        finally:
+            stats['latencies'].append(default_timer() - start)
+        if response.status_code not in (200, 403):
+            stats['errors'] += 1
+        return response
+
+    deadline = default_timer() + duration
+    while default_timer() < deadline:
+        story = random.choice(stories)
+        response = request('lock', story)
+        if response is None:
+            continue
+        stats['locks'] += 1
+        if response.status_code == 200:
+            held_from = default_timer()
+            response = request('is_locked', story)
+            if response is not None and response.status_code == 200:
+                status = simplejson.loads(response.content)
+                if status['for_user'] != username or status['applies']:
+                    stats['violations'] += 1
+            held_until = default_timer()
+            request('unlock', story)
+            stats['held'].append((story['pk'], username, held_from, held_until))
+        elif response.status_code == 403:
+            stats['refused'] += 1
+            request('is_locked', story)
+
+def work(clients, stories, duration, results):
+    # every process needs a database connection of its own
+    connection.close()
+    # and every thread its own stats, so they don't trip over each other
+    stats = [new_stats() for client in clients]
+    threads = [threading.Thread(target=hammer, args=(client, username, stories, duration, s))
+        for (username, client), s in zip(clients, stats)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    connection.close()
+    results.put(merge_stats(stats))
+
+def overlaps(held):
+    """ Counts the times two different users held the same story at once,
+    given ``(pk, username, from, until)`` tuples. """
+    count = 0
+    by_story = {}
+    for pk, username, held_from, held_until in held:
+        by_story.setdefault(pk, []).append((held_from, held_until, username))
+    for periods in by_story.values():
+        periods.sort()
+        # whoever held the story last, and until when
+        until, holder = None, None
+        for held_from, held_until, username in periods:
+            if until is not None and held_from < until and username != holder:
+                count += 1
+            if until is None or held_until > until:
+                until, holder = held_until, username
+    return count
+
+def stress(process_count, thread_count, stories, duration):
+    users = create_users(process_count * thread_count)
+    clients = []
+    for user in users:
+        client = Client()
+        client.login(username=user.username, password=PASSWORD)
+        clients.append((user.username, client))
+    # forked processes shouldn't share the connection we've been using
+    connection.close()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=work, args=(
+        clients[i * thread_count:(i + 1) * thread_count], stories, duration, results))
+        for i in range(process_count)]
+    for process in processes:
+        process.start()
+    stats = merge_stats([results.get() for process in processes])
+    for process in processes:
+        process.join()
+
+    latencies = sorted(stats['latencies'])
+    return {
+        'processes': process_count,
+        'threads': thread_count,
+        'requests': len(latencies),
+        'requests_per_sec': len(latencies) / float(duration),
+        'refused_rate': stats['refused'] / float(max(stats['locks'], 1)),
+        'p50_ms': latencies and percentile(latencies, 50) * 1000 or 0,
+        'p99_ms': latencies and percentile(latencies, 99) * 1000 or 0,
+        'errors': stats['errors'],
+        'violations': stats['violations'] + overlaps(stats['held']),
+        }
+
+def run(process_counts=(1, 2, 4, 8), thread_count=2, story_count=3, duration=5):
+    """ Runs the stress test once for each amount of processes, and returns
+    a list of results. Expects to be run against a test database that all
+    processes can reach: it creates and deletes stories and users. """
+    stories = []
+    for story in create_stories(story_count):
+        story_urls = urls(story)
+        story_urls['pk'] = story.pk
+        stories.append(story_urls)
+    results = []
+    for process_count in process_counts:
+        Story.objects.all().unlock()
+        results.append(stress(process_count, thread_count, stories, duration))
+    return results
@@ -4,8 +4,9 @@ import simplejson
 from django.core.urlresolvers import reverse
 from django.test.client import Client
 from django.contrib.auth.models import User
+from django.core.cache import get_cache
 
-from locking import models, views, LOCK_TIMEOUT
+from locking import models, views, backends, LOCK_TIMEOUT
 from locking.tests.utils import TestCase
 from locking.tests import models as testmodels
 
@@ -42,6 +43,288 @@ class AppTestCase(TestCase):
         self.story.lock_for(self.alt_user)
         self.assertRaises(models.ObjectLockedError, self.story.lock_for, self.user)
 
+    def test_atomic_lock_for(self):
+        # an atomic lock is in the database right away, no save required
+        self.story.lock_for(self.user, atomic=True)
+        self.assertTrue(self.story.is_locked)
+        story = testmodels.Story.objects.get(pk=self.story.pk)
+        self.assertTrue(story.is_locked)
+        self.assertEquals(story.locked_by, self.user)
+
+    def test_atomic_lock_for_overwrite(self):
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        # a stale in-memory copy doesn't fool the database
+        stale = testmodels.Story.objects.get(pk=self.story.pk)
+        stale._locked_at = None
+        self.assertRaises(models.ObjectLockedError, stale.lock_for, self.user, atomic=True)
+        self.assertEquals(testmodels.Story.objects.get(pk=self.story.pk).locked_by, self.alt_user)
+
+    def test_atomic_lock_for_relock(self):
+        # renewing your own lock is fine
+        self.story.lock_for(self.user, atomic=True)
+        self.story.lock_for(self.user, atomic=True)
+        self.assertTrue(self.story.is_locked)
+
+    def test_queryset_lock_for(self):
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        # the first story's lock expired long ago, the second one is taken
+        acquired, held = testmodels.Story.objects.all().lock_for(self.user)
+        self.assertEquals(acquired, set([unicode(self.alt_story.pk)]))
+        self.assertEquals(held, set([unicode(self.story.pk)]))
+        alt_story = testmodels.Story.objects.get(pk=self.alt_story.pk)
+        self.assertEquals(alt_story.locked_by, self.user)
+        self.assertTrue(alt_story.is_locked)
+
+    def test_save_lock(self):
+        self.story.lock_for(self.user)
+        self.story.content = "Not saved"
+        self.story.save_lock()
+        story = testmodels.Story.objects.get(pk=self.story.pk)
+        self.assertTrue(story.is_locked)
+        self.assertNotEquals(story.content, "Not saved")
+        self.assertEquals(self.story._state.locking, False)
+
+    def test_queryset_unlock_for(self):
+        self.story.lock_for(self.user)
+        self.story.save()
+        stories = testmodels.Story.objects.filter(pk=self.story.pk)
+        self.assertEquals(stories.unlock_for(self.alt_user), (set(), set([unicode(self.story.pk)])))
+        self.assertEquals(stories.unlock_for(self.user), (set([unicode(self.story.pk)]), set()))
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_queryset_lock_for_queries(self):
+        # reading the primary keys, a single UPDATE, and reading back what it locked
+        if isinstance(backends.get_backend(), backends.DatabaseBackend):
+            self.assertNumQueries(3, testmodels.Story.objects.all().lock_for, self.user)
+
+    def test_queryset_lock_for_unlocked(self):
+        # the rows we lock drop out of the ``unlocked`` queryset,
+        # which shouldn't keep us from reporting them
+        acquired, held = testmodels.Story.unlocked.all().lock_for(self.user)
+        self.assertEquals(acquired, set([unicode(self.story.pk), unicode(self.alt_story.pk)]))
+        self.assertEquals(held, set())
+        self.assertEquals(testmodels.Story.unlocked.count(), 0)
+
+    def test_queryset_lock_for_same_second(self):
+        # MySQL drops the microseconds, so a lock ``user`` took elsewhere 
+        # can share its timestamp with the ones we've just taken
+        if not isinstance(backends.get_backend(), backends.DatabaseBackend):
+            return
+        import types
+        now = datetime.today().replace(microsecond=0)
+        class frozen(datetime):
+            @classmethod
+            def today(cls):
+                return now
+        clock = types.ModuleType('datetime')
+        clock.datetime, clock.timedelta = frozen, timedelta
+        testmodels.Story.objects.filter(pk=self.alt_story.pk).update(
+            _locked_by=self.user, _locked_at=now, _lock_expires_at=now + timedelta(minutes=5))
+        original_clock = backends.datetime
+        backends.datetime = clock
+        try:
+            acquired, held = testmodels.Story.objects.filter(pk=self.story.pk).lock_for(self.user)
+        finally:
+            backends.datetime = original_clock
+        self.assertEquals(acquired, set([unicode(self.story.pk)]))
+        self.assertEquals(held, set())
+
+    def test_claim(self):
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        # only the other story is up for grabs
+        self.assertEquals(testmodels.Story.objects.claim(2, self.user), [self.alt_story])
+        self.assertEquals(testmodels.Story.objects.get(pk=self.alt_story.pk).locked_by, self.user)
+        # not even the same user gets to claim a story twice
+        self.assertEquals(testmodels.Story.unlocked.claim(1, self.user), [])
+
+    def test_lock_older_than_a_day(self):
+        # expired a day minus a minute ago, which is a minute to go in ``timedelta.seconds``
+        self.story.lock_for(self.user)
+        self.story._lock_expires_at = datetime.today() - timedelta(days=1) + timedelta(minutes=1)
+        self.assertFalse(self.story.is_locked)
+        self.assertTrue(self.story.lock_seconds_remaining < 0)
+
+    def test_lock_for_timeout(self):
+        self.story.lock_for(self.user, timeout=60)
+        self.assertTrue(55 < self.story.lock_seconds_remaining <= 60)
+        self.story.save()
+        story = testmodels.Story.objects.get(pk=self.story.pk)
+        self.assertTrue(55 < story.lock_seconds_remaining <= 60)
+
+    def test_model_lock_timeout(self):
+        testmodels.Story.lock_timeout = 60
+        try:
+            testmodels.Story.objects.filter(pk=self.story.pk).lock_for(self.user)
+            story = testmodels.Story.objects.get(pk=self.story.pk)
+            self.assertTrue(55 < story.lock_seconds_remaining <= 60)
+        finally:
+            del testmodels.Story.lock_timeout
+
+    def test_stored_expiry(self):
+        # whether a lock is active only depends on when it expires
+        self.story.lock_for(self.user, timeout=60)
+        self.story._lock_expires_at = datetime.today() - timedelta(seconds=1)
+        self.story.save()
+        self.assertFalse(testmodels.Story.locked.filter(pk=self.story.pk).exists())
+        self.assertTrue(testmodels.Story.unlocked.filter(pk=self.story.pk).exists())
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_with_lock_state(self):
+        if not isinstance(backends.get_backend(), backends.DatabaseBackend):
+            return
+        self.story.lock_for(self.user)
+        self.story.save()
+        stories = testmodels.Story.objects.with_lock_state().order_by('-lock_expires_in')
+        story, alt_story = stories
+        self.assertEquals((story.pk, story.lock_is_active), (self.story.pk, 1))
+        self.assertTrue(LOCK_TIMEOUT - 5 < story.lock_expires_in <= LOCK_TIMEOUT)
+        # the other story's lock expired long ago
+        self.assertEquals(alt_story.lock_is_active, 0)
+        self.assertTrue(alt_story.lock_expires_in < 0)
+
+    def test_locks_held_by(self):
+        from locking import utils
+        self.story.lock_for(self.user)
+        self.story.save()
+        self.assertEquals(list(testmodels.Story.objects.held_by(self.user)), [self.story])
+        self.assertEquals(utils.locks_held_by(self.user), {testmodels.Story: set([unicode(self.story.pk)])})
+        # the other story's lock, by alt_user, expired long ago
+        self.assertEquals(utils.locks_held_by(self.alt_user), {})
+
+    def test_release_locks_held_by(self):
+        from locking import utils
+        self.story.lock_for(self.user)
+        self.story.save()
+        self.assertEquals(utils.release_locks_held_by(self.alt_user), 0)
+        self.assertEquals(utils.release_locks_held_by(self.user), 1)
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_release_locks_on_session_expiry(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.contrib.sessions.models import Session
+        self.story.lock_for(self.user)
+        self.story.save()
+        session = SessionStore()
+        session['_auth_user_id'] = self.user.pk
+        session.save()
+        Session.objects.filter(session_key=session.session_key).update(
+            expire_date=datetime.now() - timedelta(days=1))
+        # what the ``cleanup`` command does
+        Session.objects.filter(expire_date__lt=datetime.now()).delete()
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_release_locks_on_session_expiry_when_logged_in_elsewhere(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.contrib.sessions.models import Session
+        self.story.lock_for(self.user)
+        self.story.save()
+        sessions = [SessionStore(), SessionStore()]
+        for session in sessions:
+            session['_auth_user_id'] = self.user.pk
+            session.save()
+        Session.objects.filter(session_key=sessions[0].session_key).update(
+            expire_date=datetime.now() - timedelta(days=1))
+        # the other session is still live, and may be using the lock
+        Session.objects.filter(expire_date__lt=datetime.now()).delete()
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+        Session.objects.filter(session_key=sessions[1].session_key).update(
+            expire_date=datetime.now() - timedelta(days=1))
+        Session.objects.filter(expire_date__lt=datetime.now()).delete()
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_release_locks_on_session_expiry_scan_limit(self):
+        from django.contrib.sessions.backends.db import SessionStore
+        from django.contrib.sessions.models import Session
+        self.story.lock_for(self.user)
+        self.story.save()
+        expired, other = SessionStore(), SessionStore()
+        expired['_auth_user_id'] = self.user.pk
+        expired.save()
+        other['_auth_user_id'] = self.alt_user.pk
+        other.save()
+        Session.objects.filter(session_key=expired.session_key).update(
+            expire_date=datetime.now() - timedelta(days=1))
+        # without looking through every session, we can't be sure 
+        # there's no other one, so we leave the locks be
+        original_limit = models.LOCK_SESSION_SCAN_LIMIT
+        models.LOCK_SESSION_SCAN_LIMIT = 0
+        try:
+            Session.objects.filter(expire_date__lt=datetime.now()).delete()
+        finally:
+            models.LOCK_SESSION_SCAN_LIMIT = original_limit
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_queryset_unlock(self):
+        from locking import signals
+        for story, user in ((self.story, self.user), (self.alt_story, self.alt_user)):
+            story.lock_for(user)
+            story.save()
+        released = []
+        def receiver(sender, pk, user, **kwargs):
+            released.append(pk)
+        signals.lock_released.connect(receiver)
+        try:
+            unlocked, held = testmodels.Story.locked.all().unlock()
+        finally:
+            signals.lock_released.disconnect(receiver)
+        self.assertEquals(unlocked, set([unicode(self.story.pk), unicode(self.alt_story.pk)]))
+        self.assertEquals(held, set())
+        self.assertEquals(sorted(released), sorted(unlocked))
+        self.assertEquals(testmodels.Story.locked.count(), 0)
+
+    def test_prefetch_locks(self):
+        for story in (self.story, self.alt_story):
+            story.lock_for(self.alt_user)
+            story.save()
+        # one query for the stories, one for the users holding the locks
+        stories = testmodels.Story.objects.all().prefetch_locks()
+        self.assertNumQueries(2, list, stories)
+        def check_locks():
+            for story in stories:
+                self.assertTrue(story.is_locked)
+                self.assertEquals(story.locked_by, self.alt_user)
+        self.assertNumQueries(0, check_locks)
+
+    def test_clear_expired_locks(self):
+        from locking import utils
+        self.story.lock_for(self.user)
+        self.story.save()
+        # the other story's lock expired long ago
+        self.assertEquals(utils.clear_expired_locks(batch_size=1), 
+            isinstance(backends.get_backend(), backends.DatabaseBackend) and 1 or 0)
+        alt_story = testmodels.Story.objects.get(pk=self.alt_story.pk)
+        self.assertEquals(alt_story.locked_at, None)
+        self.assertEquals(alt_story.locked_by, None)
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_clear_expired_locks_metrics(self):
+        from locking import metrics, utils
+        if not isinstance(backends.get_backend(), backends.DatabaseBackend):
+            return
+        original_collector = metrics._collector
+        metrics._collector = metrics.MemoryCollector()
+        try:
+            utils.clear_expired_locks()
+            rendered = metrics._collector.render()
+        finally:
+            metrics._collector = original_collector
+        # swept locks aren't heartbeats that lost their lock
+        self.assertTrue('locking_swept_total{model="tests.story"} 1' in rendered)
+        self.assertFalse('locking_expirations_total' in rendered)
+
+    def test_clear_expired_locks_command(self):
+        from django.core.management import call_command
+        call_command('clear_expired_locks', 'tests.story', verbosity=0)
+        self.assertEquals(testmodels.Story.objects.get(pk=self.alt_story.pk).locked_at, None)
+
+    def test_deferred_models_not_registered(self):
+        from locking import utils
+        testmodels.Story.objects.only('_locked_at').get(pk=self.story.pk)
+        self.assertEquals(sorted(utils.gather_lockable_models()["tests"].keys()), ["paragraph", "story"])
+
     def test_unlock(self):
         self.story.lock_for(self.user)
         self.story.unlock()
@@ -69,7 +352,7 @@ class AppTestCase(TestCase):
     def test_lock_expiration(self):
         self.story.lock_for(self.user)
         self.assertTrue(self.story.is_locked)
-        self.story._locked_at = datetime.today() - timedelta(minutes=LOCK_TIMEOUT+1)
+        self.story._lock_expires_at = datetime.today() - timedelta(minutes=1)
         self.assertFalse(self.story.is_locked)
     
     def test_lock_applies_to(self):
@@ -81,6 +364,76 @@ class AppTestCase(TestCase):
         self.story.lock_for(self.user)
         applies = self.story.lock_applies_to(self.user)
         self.assertFalse(applies)
+
+    def test_parent_lock(self):
+        paragraph = testmodels.Paragraph.objects.create(story=self.story)
+        self.story.lock_for(self.alt_user, atomic=True)
+        paragraph = testmodels.Paragraph.objects.get(pk=paragraph.pk)
+        # the story's lock covers its paragraphs, without locking them
+        self.assertFalse(paragraph.is_locked)
+        self.assertTrue(paragraph.lock_applies_to(self.user))
+        self.assertFalse(paragraph.lock_applies_to(self.alt_user))
+        self.assertRaises(models.ObjectLockedError, paragraph.lock_for, self.user)
+        self.assertRaises(models.ObjectLockedError, paragraph.lock_for, self.user, atomic=True)
+        # except for whoever holds the story's lock
+        paragraph.lock_for(self.alt_user, atomic=True)
+        self.assertTrue(testmodels.Paragraph.objects.get(pk=paragraph.pk).is_locked)
+
+    def test_parent_lock_querysets(self):
+        paragraph = testmodels.Paragraph.objects.create(story=self.story)
+        orphan = testmodels.Paragraph.objects.create()
+        self.story.lock_for(self.alt_user, atomic=True)
+        locked = testmodels.Paragraph.locked.values_list('pk', flat=True)
+        unlocked = testmodels.Paragraph.unlocked.values_list('pk', flat=True)
+        self.assertEquals((list(locked), list(unlocked)), ([paragraph.pk], [orphan.pk]))
+        acquired, held = testmodels.Paragraph.objects.all().lock_for(self.user)
+        self.assertEquals(acquired, set([unicode(orphan.pk)]))
+        self.assertEquals(held, set([unicode(paragraph.pk)]))
+        self.assertEquals(testmodels.Paragraph.objects.claim(2, self.alt_user), [])
+
+    def test_parent_lock_acquire_many(self):
+        # a paragraph whose lock expired before somebody else locked its
+        # story still has us as its lock holder, but we can't renew it
+        paragraph = testmodels.Paragraph.objects.create(story=self.story)
+        paragraph.lock_for(self.user)
+        paragraph._lock_expires_at = datetime.today() - timedelta(seconds=1)
+        paragraph.save()
+        self.story.lock_for(self.alt_user, atomic=True)
+        backend = backends.get_backend()
+        self.assertEquals(backend.acquire_many(testmodels.Paragraph, [paragraph.pk], self.user), set())
+        self.assertFalse(backend.acquire(testmodels.Paragraph, paragraph.pk, self.user))
+
+    def test_child_lock(self):
+        paragraph = testmodels.Paragraph.objects.create(story=self.story)
+        paragraph.lock_for(self.user, atomic=True)
+        # locking the story would cover a paragraph somebody else is editing
+        self.assertRaises(models.ObjectLockedError, self.story.lock_for, self.alt_user, atomic=True)
+        story = testmodels.Story.objects.get(pk=self.story.pk)
+        self.assertRaises(models.ObjectLockedError, story.lock_for, self.alt_user)
+        self.assertEquals(testmodels.Story.objects.claim(2, self.alt_user), [self.alt_story])
+        backend = backends.get_backend()
+        lock = backend.get_blocking(testmodels.Story, self.story.pk, self.alt_user)
+        self.assertEquals(lock.locked_by_id, self.user.pk)
+        # but the one editing the paragraph can lock the whole story
+        self.story.lock_for(self.user, atomic=True)
+
+    def test_parent_lock_prefetched(self):
+        for i in range(3):
+            testmodels.Paragraph.objects.create(story=self.story)
+        self.story.lock_for(self.alt_user, atomic=True)
+        paragraphs = list(testmodels.Paragraph.objects.all().prefetch_locks())
+        # the story's lock came along with the paragraphs
+        for paragraph in paragraphs:
+            self.assertNumQueries(0, paragraph.lock_applies_to, self.user)
+            self.assertTrue(paragraph.lock_applies_to(self.user))
+            self.assertFalse(paragraph.lock_applies_to(self.alt_user))
+
+    def test_lock_applies_to_without_queries(self):
+        self.story.lock_for(self.alt_user, atomic=True)
+        story = testmodels.Story.objects.get(pk=self.story.pk)
+        story.is_locked
+        # no need to fetch the lock holder
+        self.assertNumQueries(0, story.lock_applies_to, self.user)
     
     def test_is_locked_by(self):
         self.story.lock_for(self.user)
@@ -98,6 +451,12 @@ class AppTestCase(TestCase):
         self.assertTrue("story" in lockable_models["tests"])
         self.assertTrue("unlockable" not in lockable_models["tests"])
 
+    def test_lockable_model_registry(self):
+        from locking.registry import lockable_models
+        self.assertEquals(lockable_models.get("tests", "story"), testmodels.Story)
+        self.assertEquals(lockable_models.get("tests", "unlockable"), None)
+        self.assertTrue(("tests", "story") in lockable_models)
+
     def test_locking_bit_when_locking(self):
         # when we've locked something, we should set an administrative
         # bit so other developers can know a save will do a lock or 
@@ -148,6 +507,129 @@ class AppTestCase(TestCase):
         self.assertEquals(unlocked.count(), 1)
         self.assertTrue(len(set(locked).intersection(set(unlocked))) == 0)
 
+class HistoryTestCase(TestCase):
+    fixtures = ['locking_scenario',]
+
+    def setUp(self):
+        from locking import history
+        self.alt_story, self.story = testmodels.Story.objects.all()
+        self.user, self.alt_user = User.objects.all()
+        # no writer thread, we flush by hand
+        self.history = history.History(batch_size=2, queue_size=5, background=False)
+        self._original_history, history.history = history.history, self.history
+        history.connect()
+
+    def tearDown(self):
+        from locking import history, signals
+        history.history = self._original_history
+        signals.lock_acquired.disconnect(history.record_acquired)
+        signals.lock_released.disconnect(history.record_released)
+        signals.lock_contended.disconnect(history.record_contended)
+
+    def test_history(self):
+        self.story.lock_for(self.user, atomic=True)
+        self.assertRaises(models.ObjectLockedError, self.story.lock_for, self.alt_user, atomic=True)
+        testmodels.Story.objects.filter(pk=self.story.pk).unlock_for(self.user)
+        # nothing gets written until the history is flushed
+        self.assertEquals(models.LockEvent.objects.count(), 0)
+        self.history.flush()
+        events = models.LockEvent.objects.values_list('action', 'object_id', 'username')
+        pk = unicode(self.story.pk)
+        self.assertEquals(list(events), [
+            ('acquired', pk, self.user.username), 
+            ('contended', pk, self.alt_user.username), 
+            ('released', pk, self.user.username),
+            ])
+
+    def test_history_batches(self):
+        for i in range(5):
+            self.history.record(testmodels.Story, self.story.pk, 'acquired', self.user)
+        # one insert per batch of two events
+        self.assertNumQueries(3, self.history.flush)
+        self.assertEquals(models.LockEvent.objects.count(), 5)
+
+    def test_history_drops_events_when_full(self):
+        for i in range(5):
+            self.assertTrue(self.history.record(testmodels.Story, self.story.pk, 'acquired'))
+        self.assertFalse(self.history.record(testmodels.Story, self.story.pk, 'released'))
+        self.history.flush()
+        self.assertEquals(set(models.LockEvent.objects.values_list('action', flat=True)), set(['acquired']))
+
+class CacheBackendMixin(object):
+    # runs a test case again, with locks stored in a cache
+    # instead of in the database
+
+    def setUp(self):
+        self._original_backend = backends._backend
+        backends._backend = backends.CacheBackend(get_cache('locmem://'))
+        super(CacheBackendMixin, self).setUp()
+
+    def tearDown(self):
+        super(CacheBackendMixin, self).tearDown()
+        backends._backend.cache.clear()
+        backends._backend = self._original_backend
+
+class CacheBackendTestCase(CacheBackendMixin, AppTestCase):
+    def test_lock_stays_out_of_database(self):
+        self.story.lock_for(self.user, atomic=True)
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+        values = testmodels.Story.objects.filter(pk=self.story.pk).values('_locked_at')
+        self.assertEquals(values[0]['_locked_at'], None)
+
+    def test_index_busy(self):
+        from locking import utils
+        backend = backends.get_backend()
+        key = backend._index_key(testmodels.Story)
+        # somebody else is updating the index, for longer than we'll wait
+        backend.cache.add(key + ':mutex', 1, 5)
+        self.story.lock_for(self.user, atomic=True)
+        self.assertEquals(backend.cache.get(key), None)
+        self.assertEquals(list(testmodels.Story.locked.values_list('pk', flat=True)), [self.story.pk])
+        self.assertFalse(testmodels.Story.unlocked.filter(pk=self.story.pk).exists())
+        # once the index is free again, sweeping completes it
+        backend.cache.delete(key + ':mutex')
+        utils.clear_expired_locks()
+        self.assertEquals(backend.cache.get(key + ':stale'), None)
+        self.assertEquals(backend.cache.get(key).keys(), [unicode(self.story.pk)])
+        self.assertEquals(list(testmodels.Story.locked.values_list('pk', flat=True)), [self.story.pk])
+
+class StatusCacheTestCase(TestCase):
+    fixtures = ['locking_scenario',]
+
+    def setUp(self):
+        self.alt_story, self.story = testmodels.Story.objects.all()
+        self.user, self.alt_user = User.objects.all()
+        self._original_backend = backends._backend
+        backends._backend = backends.DatabaseBackend(get_cache('locmem://'), status_timeout=60)
+
+    def tearDown(self):
+        backends._backend.cache.clear()
+        backends._backend = self._original_backend
+
+    def test_status_cache(self):
+        backend = backends.get_backend()
+        self.assertNumQueries(1, backend.get, testmodels.Story, self.story.pk)
+        self.assertNumQueries(0, backend.get, testmodels.Story, self.story.pk)
+        # locking, renewing and unlocking clear the cached status
+        self.story.lock_for(self.user, atomic=True)
+        self.assertTrue(backend.get(testmodels.Story, self.story.pk).is_active)
+        backend.renew(testmodels.Story, self.story.pk, self.user, timeout=60)
+        self.assertTrue(backend.get(testmodels.Story, self.story.pk).seconds_remaining <= 60)
+        testmodels.Story.objects.filter(pk=self.story.pk).unlock()
+        self.assertFalse(backend.get(testmodels.Story, self.story.pk).is_active)
+
+    def test_status_cache_many(self):
+        backend = backends.get_backend()
+        backend.get(testmodels.Story, self.story.pk)
+        pks = [self.story.pk, self.alt_story.pk]
+        # only what isn't cached yet gets looked up, in one query
+        self.assertNumQueries(1, backend.get_many, testmodels.Story, pks)
+        self.assertNumQueries(0, backend.get_many, testmodels.Story, pks)
+        self.story.lock_for(self.user, atomic=True)
+        locks = backend.get_many(testmodels.Story, pks)
+        self.assertTrue(locks[unicode(self.story.pk)].is_active)
+        self.assertFalse(locks[unicode(self.alt_story.pk)].is_active)
+
 users = [
     # Stan is a superuser
     {"username": "Stan", "password": "green pastures"},
@@ -177,8 +659,13 @@ class BrowserTestCase(TestCase):
             "changelist": reverse('admin:tests_story_changelist'),
             "lock": reverse(views.lock, args=story_args),
             "unlock": reverse(views.unlock, args=story_args),
+            "renew": reverse(views.renew, args=story_args),
             "is_locked": reverse(views.is_locked, args=story_args),
+            "wait": reverse(views.wait, args=story_args),
             "js_variables": reverse(views.js_variables),
+            "batch": reverse(views.batch),
+            "release": reverse(views.release),
+            "metrics": reverse(views.metrics),
             }
     
     def tearDown(self):
@@ -209,6 +696,42 @@ class BrowserTestCase(TestCase):
         res = self.c.get(self.urls['lock'])        
         self.assertEquals(res.status_code, 401)
     
+    def test_permission_cache(self):
+        self.c.logout()
+        self.c.login(**users[1])
+        self.assertEquals(self.c.get(self.urls['lock']).status_code, 401)
+        # the answer is remembered in the session
+        cached = self.c.session['locking_permissions']
+        self.assertEquals(cached['permissions'], {'tests.change_story': False})
+        self.assertEquals(self.c.get(self.urls['lock']).status_code, 401)
+
+    def test_permission_cache_only_for_lockable_models(self):
+        self.c.logout()
+        self.c.login(**users[1])
+        self.assertEquals(self.c.get(self.urls['lock']).status_code, 401)
+        # made-up models don't get as far as the permission check
+        url = reverse(views.lock, args=['made', 'up', 1])
+        self.assertEquals(self.c.get(url).status_code, 404)
+        entries = [["made", "up-too", 1, "is_locked"]]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        self.assertEquals(simplejson.loads(res.content)["made/up-too/1"]["status"], 404)
+        cached = self.c.session['locking_permissions']
+        self.assertEquals(cached['permissions'], {'tests.change_story': False})
+
+    def test_permission_check_without_queries(self):
+        from django.contrib.auth.models import AnonymousUser
+        from django.test.client import RequestFactory
+        from locking.decorators import may_change
+        request = RequestFactory().get(self.urls['lock'])
+        request.user = AnonymousUser()
+        self.assertNumQueries(0, lambda: self.assertFalse(may_change(request, 'tests', 'story')))
+        request.user = self.user
+        self.assertNumQueries(0, lambda: self.assertTrue(may_change(request, 'tests', 'story')))
+        request.user = self.alt_user
+        self.assertFalse(may_change(request, 'tests', 'story'))
+        self.assertNumQueries(0, lambda: self.assertFalse(may_change(request, 'tests', 'story')))
+
     def test_lock_when_does_not_apply(self):
         # don't make a resource available to lock models that don't 
         # have locking enabled -- this tests the is_lockable decorator
@@ -218,12 +741,64 @@ class BrowserTestCase(TestCase):
         res = self.c.get(url)        
         self.assertEquals(res.status_code, 404)              
     
+    def test_lock_when_missing(self):
+        # the cache backend doesn't look at the database when locking
+        if not backends.get_backend().persists_with_model:
+            return
+        args = [self.story._meta.app_label, self.story._meta.module_name, 999999]
+        res = self.c.get(reverse(views.lock, args=args))
+        self.assertEquals(res.status_code, 404)
+
     def test_lock_when_disallowed(self):
         self.story.lock_for(self.alt_user)
         self.story.save()
         res = self.c.get(self.urls['lock'])        
         self.assertEquals(res.status_code, 403)
     
+    def test_lock_reports_status(self):
+        # an edit page finds out whether it may edit with a single request
+        res = simplejson.loads(self.c.get(self.urls['lock']).content)
+        self.assertFalse(res['applies'])
+        self.assertEquals(res['for_user'], self.user.username)
+        self.assertTrue(res['seconds_remaining'] > LOCK_TIMEOUT - 5)
+    
+    def test_lock_reports_holder_when_disallowed(self):
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        res = self.c.get(self.urls['lock'])
+        self.assertEquals(res.status_code, 403)
+        res = simplejson.loads(res.content)
+        self.assertTrue(res['applies'])
+        self.assertEquals(res['for_user'], self.alt_user.username)
+        self.assertTrue(0 < res['seconds_remaining'] <= LOCK_TIMEOUT)
+    
+    def test_lock_reports_parent_lock_when_disallowed(self):
+        paragraph = testmodels.Paragraph.objects.create(story=self.story)
+        self.story.lock_for(self.alt_user, atomic=True)
+        url = reverse(views.lock, args=[paragraph._meta.app_label, paragraph._meta.module_name, paragraph.pk])
+        res = self.c.get(url)
+        self.assertEquals(res.status_code, 403)
+        # the paragraph itself isn't locked, the story it's part of is
+        res = simplejson.loads(res.content)
+        self.assertTrue(res['is_active'])
+        self.assertTrue(res['applies'])
+        self.assertEquals(res['for_user'], self.alt_user.username)
+        self.assertTrue(0 < res['seconds_remaining'] <= LOCK_TIMEOUT)
+
+    def test_is_locked_reports_parent_lock(self):
+        paragraph = testmodels.Paragraph.objects.create(story=self.story)
+        self.story.lock_for(self.alt_user, atomic=True)
+        args = [paragraph._meta.app_label, paragraph._meta.module_name, paragraph.pk]
+        res = simplejson.loads(self.c.get(reverse(views.is_locked, args=args)).content)
+        self.assertTrue(res['applies'])
+        self.assertEquals(res['for_user'], self.alt_user.username)
+        entries = [["tests", "paragraph", paragraph.pk, "is_locked"]]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        res = simplejson.loads(res.content)["tests/paragraph/%s" % paragraph.pk]
+        self.assertTrue(res['applies'])
+        self.assertEquals(res['for_user'], self.alt_user.username)
+
     def test_unlock_when_allowed(self):
         self.story.lock_for(self.user)
         self.story.save()
@@ -233,6 +808,30 @@ class BrowserTestCase(TestCase):
         story = testmodels.Story.objects.get(pk=self.story.id)
         self.assertFalse(story.is_locked)
     
+    def test_renew_when_allowed(self):
+        self.story.lock_for(self.user)
+        self.story.save()
+        res = self.c.get(self.urls['renew'])
+        self.assertEquals(res.status_code, 200)
+        story = testmodels.Story.objects.get(pk=self.story.id)
+        self.assertTrue(story.is_locked)
+        self.assertTrue(story.locked_at > self.story.locked_at)
+
+    def test_renew_when_disallowed(self):
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        res = self.c.get(self.urls['renew'])
+        self.assertEquals(res.status_code, 403)
+        story = testmodels.Story.objects.get(pk=self.story.id)
+        self.assertEquals(story.locked_by, self.alt_user)
+
+    def test_renew_when_unlocked(self):
+        # a heartbeat never acquires a lock by itself
+        res = self.c.get(self.urls['renew'])
+        self.assertEquals(res.status_code, 403)
+        story = testmodels.Story.objects.get(pk=self.story.id)
+        self.assertFalse(story.is_locked)
+
     def test_unlock_when_disallowed(self):
         self.story.lock_for(self.alt_user)
         self.story.save()
@@ -255,14 +854,244 @@ class BrowserTestCase(TestCase):
         self.assertFalse(res['applies'])
         self.assertTrue(res['is_active'])
 
+    def test_batch(self):
+        alt_story = testmodels.Story.objects.exclude(pk=self.story.pk)[0]
+        alt_story.lock_for(self.alt_user)
+        alt_story.save()
+        entries = [
+            ["tests", "story", self.story.pk, "lock"],
+            ["tests", "story", alt_story.pk, "lock"],
+            ["tests", "unlockable", 1, "is_locked"],
+            ["tests", "story", "not-an-id", "lock"],
+            ]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        self.assertEquals(res.status_code, 200)
+        res = simplejson.loads(res.content)
+        self.assertEquals(res["tests/story/%s" % self.story.pk]["status"], 200)
+        self.assertEquals(res["tests/story/%s" % alt_story.pk]["status"], 403)
+        self.assertEquals(res["tests/unlockable/1"]["status"], 404)
+        self.assertEquals(res["tests/story/not-an-id"]["status"], 400)
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_batch_status_and_unlock(self):
+        self.story.lock_for(self.user)
+        self.story.save()
+        entries = [["tests", "story", self.story.pk, "unlock"]]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        self.assertEquals(simplejson.loads(res.content)["tests/story/%s" % self.story.pk]["status"], 200)
+        entries = [["tests", "story", self.story.pk, "is_locked"]]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        status = simplejson.loads(res.content)["tests/story/%s" % self.story.pk]
+        self.assertFalse(status["is_active"])
+        self.assertFalse(status["applies"])
+
+    def test_batch_when_unauthorized(self):
+        self.c.logout()
+        self.c.login(**users[1])
+        entries = [["tests", "story", self.story.pk, "lock"]]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        self.assertEquals(simplejson.loads(res.content)["tests/story/%s" % self.story.pk]["status"], 401)
+
+    def test_batch_malformed(self):
+        res = self.c.post(self.urls['batch'], "{", content_type='application/json')
+        self.assertEquals(res.status_code, 400)
+        res = self.c.get(self.urls['batch'])
+        self.assertEquals(res.status_code, 405)
+        # malformed entries only fail by themselves
+        alt_story = testmodels.Story.objects.exclude(pk=self.story.pk)[0]
+        entries = [
+            ["tests", "story", [1], "is_locked"],
+            ["tests", "story", {"id": 1}, "is_locked"],
+            ["tests", "story", alt_story.pk, ["lock"]],
+            ["tests", "story", self.story.pk, "is_locked"],
+            ]
+        res = self.c.post(self.urls['batch'], simplejson.dumps(entries), 
+            content_type='application/json')
+        self.assertEquals(res.status_code, 200)
+        statuses = [status["status"] for status in simplejson.loads(res.content).values()]
+        self.assertEquals(sorted(statuses), [200, 400, 400, 400])
+
+    def test_batch_csrf(self):
+        from django.middleware.csrf import _get_new_csrf_key
+        c = Client(enforce_csrf_checks=True)
+        c.login(**users[0])
+        entries = simplejson.dumps([["tests", "story", self.story.pk, "is_locked"]])
+        res = c.post(self.urls['batch'], entries, content_type='application/json')
+        self.assertEquals(res.status_code, 403)
+        # JSON clients send the token along in a header
+        token = _get_new_csrf_key()
+        c.cookies['csrftoken'] = token
+        res = c.post(self.urls['batch'], entries, content_type='application/json',
+            HTTP_X_CSRFTOKEN=token)
+        self.assertEquals(res.status_code, 200)
+
+    def test_release(self):
+        alt_story = testmodels.Story.objects.exclude(pk=self.story.pk)[0]
+        self.story.lock_for(self.user)
+        self.story.save()
+        alt_story.lock_for(self.alt_user)
+        alt_story.save()
+        objects = [["tests", "story", self.story.pk], ["tests", "story", alt_story.pk]]
+        res = self.c.post(self.urls['release'], {'objects': simplejson.dumps(objects)})
+        self.assertEquals(res.status_code, 200)
+        res = simplejson.loads(res.content)
+        self.assertEquals(res["tests/story/%s" % self.story.pk]["status"], 200)
+        # only our own locks get released
+        self.assertEquals(res["tests/story/%s" % alt_story.pk]["status"], 403)
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+        self.assertTrue(testmodels.Story.objects.get(pk=alt_story.pk).is_locked)
+
+    def test_release_malformed(self):
+        res = self.c.post(self.urls['release'], {'objects': '[["tests", "story"]]'})
+        self.assertEquals(res.status_code, 400)
+        res = self.c.post(self.urls['release'])
+        self.assertEquals(res.status_code, 400)
+        res = self.c.get(self.urls['release'])
+        self.assertEquals(res.status_code, 405)
+
+    def test_metrics(self):
+        from locking import metrics
+        original_collector = metrics._collector
+        metrics._collector = metrics.MemoryCollector()
+        try:
+            self.story.lock_for(self.alt_user)
+            self.story.save()
+            self.c.get(self.urls['lock'])
+            self.story.unlock()
+            self.story.save()
+            self.c.get(self.urls['lock'])
+            self.c.get(reverse(views.lock, args=['made', 'up', 1]))
+            res = self.c.get(self.urls['metrics'])
+        finally:
+            metrics._collector = original_collector
+        self.assertEquals(res.status_code, 200)
+        self.assertFalse('made.up' in res.content)
+        self.assertContains(res, 'locking_acquisitions_total{model="tests.story"} 2')
+        self.assertContains(res, 'locking_contentions_total{model="tests.story"} 1')
+        self.assertContains(res, 'locking_view_seconds_count{model="tests.story",view="lock"} 2')
+
+    def test_renew_metrics(self):
+        from locking import metrics
+        original_collector = metrics._collector
+        metrics._collector = collector = metrics.MemoryCollector()
+        try:
+            # a heartbeat is no acquisition, and a lock we never held 
+            # (or that somebody else holds) hasn't expired on us
+            self.story.lock_for(self.user)
+            self.story.save()
+            self.c.get(self.urls['renew'])
+            self.story.unlock()
+            self.story.lock_for(self.alt_user)
+            self.story.save()
+            self.c.get(self.urls['renew'])
+            self.story.unlock()
+            self.story.save()
+            self.c.get(self.urls['renew'])
+            self.story.lock_for(self.user)
+            self.story._lock_expires_at = datetime.today() - timedelta(seconds=1)
+            self.story.save()
+            self.c.get(self.urls['renew'])
+            # nor is a lock that hasn't been saved yet
+            self.story.lock_for(self.user)
+            res = collector.render()
+        finally:
+            metrics._collector = original_collector
+        self.assertTrue('locking_renewals_total{model="tests.story"} 1' in res)
+        self.assertTrue('locking_acquisitions_total{model="tests.story"} 3' in res)
+        if isinstance(backends.get_backend(), backends.DatabaseBackend):
+            self.assertTrue('locking_expirations_total{model="tests.story"} 1' in res)
+        else:
+            self.assertFalse('locking_expirations_total' in res)
+
+    def test_metrics_when_unauthorized(self):
+        self.c.logout()
+        self.c.login(**users[1])
+        res = self.c.get(self.urls['metrics'])
+        self.assertEquals(res.status_code, 401)
+
+    def test_wait_when_changed(self):
+        # if the lock has changed since we last checked, 
+        # there's no need to wait for anything
+        res = self.c.get(self.urls['wait'], {'version': 'outdated'})
+        res = simplejson.loads(res.content)
+        self.assertFalse(res['is_active'])
+        self.assertEquals(res['version'], 'unlocked')
+
+    def test_wait_until_signalled(self):
+        import threading
+        import time
+        from locking import signals
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        version = simplejson.loads(self.c.get(self.urls['is_locked']).content)['version']
+        # a lock signal wakes up the waiting request long before it times out
+        def notify():
+            signals.lock_released.send(sender=testmodels.Story, pk=self.story.pk, user=None)
+        original_timeout = views.LOCK_POLL_TIMEOUT
+        views.LOCK_POLL_TIMEOUT = 25
+        timer = threading.Timer(0.2, notify)
+        timer.start()
+        start = time.time()
+        try:
+            res = self.c.get(self.urls['wait'], {'version': version})
+        finally:
+            timer.join()
+            views.LOCK_POLL_TIMEOUT = original_timeout
+        self.assertTrue(0.2 <= time.time() - start < 5)
+        self.assertEquals(simplejson.loads(res.content)['version'], version)
+
+    def test_wait_without_poll_timeout(self):
+        # long-polling is off unless ``LOCK_POLL_TIMEOUT`` is set, 
+        # in which case ``wait`` is no different from ``is_locked``
+        self.assertEquals(views.LOCK_POLL_TIMEOUT, None)
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        version = simplejson.loads(self.c.get(self.urls['is_locked']).content)['version']
+        res = self.c.get(self.urls['wait'], {'version': version})
+        self.assertEquals(simplejson.loads(res.content)['version'], version)
+        res = self.c.get(self.urls['js_variables'])
+        self.assertContains(res, '"poll_timeout": null')
+
+    def test_subscriptions(self):
+        from locking.notifications import subscriptions
+        event = subscriptions.subscribe(testmodels.Story, self.story.pk)
+        self.story.lock_for(self.user)
+        self.story.save()
+        self.assertTrue(event.isSet())
+        subscriptions.unsubscribe(testmodels.Story, self.story.pk, event)
+        self.assertEquals(subscriptions._waiters, {})
+
     def test_js_variables(self):
         res = self.c.get(self.urls['js_variables'])
         self.assertEquals(res.status_code, 200)
         self.assertContains(res, LOCK_TIMEOUT)
     
+    def test_js_variables_caching(self):
+        res = self.c.get(self.urls['js_variables'], {'v': views.JS_VARIABLES_VERSION})
+        self.assertTrue('max-age' in res['Cache-Control'])
+        res = self.c.get(self.urls['js_variables'], HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEquals(res.status_code, 304)
+
+    def test_is_locked_not_modified(self):
+        res = self.c.get(self.urls['is_locked'])
+        etag = res['ETag']
+        res = self.c.get(self.urls['is_locked'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(res.status_code, 304)
+        self.assertEquals(res.content, '')
+        self.story.lock_for(self.alt_user)
+        self.story.save()
+        res = self.c.get(self.urls['is_locked'], HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(res.status_code, 200)
+        self.assertNotEquals(res['ETag'], etag)
+
     def test_admin_media(self):
         res = self.c.get(self.urls['change'])
         self.assertContains(res, 'admin.locking.js')
+        self.assertContains(res, 'variables.js?v=%s' % views.JS_VARIABLES_VERSION)
     
     def test_admin_changelist_when_locked(self):
         self.story.lock_for(self.alt_user)
@@ -277,4 +1106,56 @@ class BrowserTestCase(TestCase):
     
     def test_admin_changelist_when_unlocked(self):
         res = self.c.get(self.urls['changelist'])
-        self.assertNotContains(res, 'locking/img')
\ No newline at end of file
+        self.assertNotContains(res, 'locking/img')
+
+    def test_admin_changelist_lock_filter(self):
+        alt_story = testmodels.Story.objects.exclude(pk=self.story.pk)[0]
+        alt_story.lock_for(self.alt_user)
+        alt_story.save()
+        self.c.get(self.urls['lock'])
+        for value, stories in (('locked', [self.story, alt_story]), 
+            ('unlocked', []), ('mine', [self.story])):
+            res = self.c.get(self.urls['changelist'], {'lock': value, 'o': 1})
+            self.assertEquals(res.status_code, 200)
+            self.assertEquals(sorted(story.pk for story in res.context['cl'].result_list), 
+                sorted(story.pk for story in stories))
+        self.assertContains(res, 'Locked by me')
+        res = self.c.get(self.urls['changelist'], {'lock': 'nonsense'})
+        self.assertEquals(res.status_code, 302)
+
+    def test_admin_changelist_lock_filter_database_clock(self):
+        if not isinstance(backends.get_backend(), backends.DatabaseBackend):
+            return
+        self.c.get(self.urls['lock'])
+        # an expired lock is still in the lock columns, but doesn't count
+        alt_story = testmodels.Story.objects.exclude(pk=self.story.pk)[0]
+        testmodels.Story.objects.filter(pk=alt_story.pk).update(
+            _locked_by=self.user, _locked_at=datetime(2000, 1, 1), 
+            _lock_expires_at=datetime(2000, 1, 1, 0, 30))
+        for value, stories in (('locked', [self.story]), ('unlocked', [alt_story]), 
+            ('mine', [self.story])):
+            res = self.c.get(self.urls['changelist'], {'lock': value})
+            result_list = res.context['cl'].result_list
+            self.assertEquals([story.pk for story in result_list], [story.pk for story in stories])
+            # filtered on the same expressions the database annotated them with
+            self.assertEquals([story.lock_is_active for story in result_list], 
+                [int(value != 'unlocked')])
+
+    def test_release_locks_on_logout(self):
+        self.c.get(self.urls['lock'])
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+        self.c.get(reverse('admin:logout'))
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+    def test_release_locks_on_logout_when_logged_in_elsewhere(self):
+        other = Client()
+        other.login(**users[0])
+        self.c.get(self.urls['lock'])
+        # the other browser may still be using the lock
+        self.c.get(reverse('admin:logout'))
+        self.assertTrue(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+        other.get(reverse('admin:logout'))
+        self.assertFalse(testmodels.Story.objects.get(pk=self.story.pk).is_locked)
+
+class CacheBackendBrowserTestCase(CacheBackendMixin, BrowserTestCase):
+    pass
@@ -3,9 +3,14 @@ from django.conf.urls.defaults import *
 urlpatterns = patterns('locking.views',
     # verwijst naar een ajax-view voor het lockingmechanisme
     (r'(?P<app>[\w-]+)/(?P<model>[\w-]+)/(?P<id>\d+)/lock/$', 'lock'),
+    (r'(?P<app>[\w-]+)/(?P<model>[\w-]+)/(?P<id>\d+)/renew/$', 'renew'),
     (r'(?P<app>[\w-]+)/(?P<model>[\w-]+)/(?P<id>\d+)/unlock/$', 'unlock'),
     (r'(?P<app>[\w-]+)/(?P<model>[\w-]+)/(?P<id>\d+)/is_locked/$', 'is_locked'),
+    (r'(?P<app>[\w-]+)/(?P<model>[\w-]+)/(?P<id>\d+)/wait/$', 'wait'),
+    (r'batch/$', 'batch', {}, 'locking_batch'),
+    (r'release/$', 'release', {}, 'locking_release'),
     (r'variables\.js$', 'js_variables', {}, 'locking_variables'),
+    (r'metrics/$', 'metrics', {}, 'locking_metrics'),
     )
 
 urlpatterns += patterns('',
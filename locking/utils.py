@@ -1,17 +1,64 @@
 # encoding: utf-8
 
-from django.contrib.contenttypes.models import ContentType
-from locking.models import LockableModel
+from django.utils.encoding import force_unicode
+
+from locking.registry import lockable_models
+from locking.backends import get_backend
+from locking import metrics
 
 def gather_lockable_models():
-    lockable_models = dict()
-    for contenttype in ContentType.objects.all():
-        model = contenttype.model_class()
-        # there might be a None value betwixt our content types
-        if model:
-            app = model._meta.app_label
-            name = model._meta.module_name
-            if issubclass(model, LockableModel):
-                lockable_models.setdefault(app, {})
-                lockable_models[app][name] = model
-    return lockable_models
\ No newline at end of file
+    """ Returns a ``{app: {model: class}}`` dictionary of all lockable models.
+    Served from the model registry, so this doesn't hit the database. """
+    return lockable_models.by_app()
+
+def clear_expired_locks(models=None, batch_size=1000):
+    """
+    Clears out expired locks on ``models`` (by default, all lockable models), 
+    ``batch_size`` locks at a time, so big tables don't get locked up by a 
+    single huge ``UPDATE``. Returns the amount of locks that were cleared.
+    
+    Expired locks don't apply to anyone, so this isn't needed for correctness, 
+    but it keeps stale lock holders out of your data and the lock index small.
+    """
+    if models is None:
+        models = list(lockable_models)
+    cleared = 0
+    backend = get_backend()
+    for model in models:
+        # proxies share their table (and their locks) with another model
+        if model._meta.proxy:
+            continue
+        swept = backend.sweep(model, batch_size)
+        metrics.count('swept', model, swept)
+        cleared += swept
+    return cleared
+
+def _lockable_tables():
+    return [model for model in lockable_models if not model._meta.proxy]
+
+def locks_held_by(user):
+    """
+    Returns a ``{model: set(primary keys)}`` dictionary of every object, of 
+    any lockable model, that ``user`` holds an active lock on. That's a single
+    indexed query per lockable model. Models without any locks by ``user`` 
+    are left out.
+    """
+    held = {}
+    for model in _lockable_tables():
+        pks = model.objects.held_by(user).values_list('pk', flat=True)
+        if pks:
+            held[model] = set(force_unicode(pk) for pk in pks)
+    return held
+
+def release_locks_held_by(user):
+    """
+    Releases every lock ``user`` holds, on all lockable models. With the 
+    database backend, that's a query per model, plus an ``UPDATE`` for 
+    those models ``user`` has actually locked something of. Returns the
+    amount of locks that were released.
+    """
+    released = 0
+    for model in _lockable_tables():
+        unlocked, held = model.objects.held_by(user).unlock_for(user)
+        released += len(unlocked)
+    return released
@@ -1,10 +1,23 @@
 import simplejson
+from datetime import datetime
 
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotAllowed, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.hashcompat import md5_constructor
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import condition
 from django.core.urlresolvers import reverse
+from django.core.exceptions import ValidationError
+from django.utils.encoding import force_unicode
 
-from locking.decorators import user_may_change_model, is_lockable, log
-from locking import utils, LOCK_TIMEOUT, logger, models
+from locking.decorators import user_may_change_model, is_lockable, log, timed, may_change
+from locking.metrics import get_collector, count
+from locking.registry import lockable_models
+from locking.backends import Lock, get_backend, concrete_model, expiry
+from locking.notifications import subscriptions
+from locking import VERSION, LOCK_TIMEOUT, LOCK_RENEWAL_INTERVAL, LOCK_POLL_TIMEOUT
+from locking import signals
 
 """
 These views are called from javascript to open and close assets (objects), in order
@@ -12,57 +25,292 @@ to prevent concurrent editing.
 """
 
 @log
-@user_may_change_model
+@timed
 @is_lockable
+@user_may_change_model
 def lock(request, app, model, id):
-    obj = utils.gather_lockable_models()[app][model].objects.get(pk=id)
+    """
+    Tries to lock an object for the current user. Responds with 200 if the
+    lock was acquired or renewed, and with 403 if somebody else holds it.
+    Either way, the response is the lock status (as in ``is_locked``) plus
+    the ``seconds_remaining`` on the lock, so an edit page only needs this
+    one request to find out whether it may edit the object.
+    """
+    cls = lockable_models.get(app, model)
+    backend = get_backend()
 
-    try:
-        obj.lock_for(request.user)
-        obj.save()
-        return HttpResponse(status=200)
-    except models.ObjectLockedError:
+    # Checking and acquiring the lock happens in a single atomic operation
+    # (with the database backend, a conditional UPDATE), so two users can't
+    # both get hold of the same lock.
+    if backend.acquire(cls, id, request.user):
+        count('acquisitions', cls)
+        signals.lock_acquired.send(sender=concrete_model(cls), pk=id, user=request.user)
+        # we know what the lock looks like, no need to fetch it
+        now = datetime.today()
+        lock = Lock(now, request.user.pk, request.user.username, False, expiry(cls, now=now))
+        status = 200
+    elif not cls.objects.filter(pk=id).exists():
+        # the conditional UPDATE doesn't tell a missing row 
+        # from a locked one, so we only look when it fails
+        return HttpResponse(status=404)
+    else:
         # The user tried to overwrite an existing lock by another user.
-        # No can do, pal!
+        # No can do, pal! We do tell them who's got it, and for how long, 
+        # even if it's a lock on e.g. the article this paragraph is part of.
+        count('contentions', cls)
+        signals.lock_contended.send(sender=concrete_model(cls), pk=id, user=request.user)
+        lock = backend.get_blocking(cls, id, request.user)
+        status = 403
+
+    response = _lock_status(lock, request.user)
+    response['seconds_remaining'] = lock.seconds_remaining
+    return HttpResponse(simplejson.dumps(response), status=status, mimetype='application/json')
+
+@log
+@timed
+@is_lockable
+@user_may_change_model
+def renew(request, app, model, id):
+    cls = lockable_models.get(app, model)
+
+    # The heartbeat of an open edit page. This only extends a lock the user
+    # still holds, it never acquires one, so the page can find out if it 
+    # lost its lock in the meantime.
+    backend = get_backend()
+    if backend.renew(cls, id, request.user):
+        count('renewals', cls)
+        return HttpResponse(status=200)
+    else:
+        # The lock might have expired, or never have been ours to begin
+        # with. Only the former counts as an expiration.
+        lock = backend.get(cls, id)
+        if lock.locked_by_id == request.user.pk and not lock.is_active:
+            count('expirations', cls)
         return HttpResponse(status=403)
 
 @log
+@is_lockable
 @user_may_change_model
+def wait(request, app, model, id):
+    """
+    Long-polling version of ``is_locked``. Pass the ``version`` you got from
+    ``is_locked`` (or from a previous ``wait``) as a GET parameter, and this
+    view will respond as soon as the lock is acquired, released or expires,
+    or after ``LOCK_POLL_TIMEOUT`` seconds, whichever comes first. When
+    ``LOCK_POLL_TIMEOUT`` isn't set, this answers right away, like ``is_locked``.
+    """
+    cls = lockable_models.get(app, model)
+    backend = get_backend()
+    
+    # subscribe before checking the lock, so we can't miss a change
+    # that happens right in between
+    event = subscriptions.subscribe(cls, id)
+    try:
+        lock = backend.get_blocking(cls, id, request.user)
+        if LOCK_POLL_TIMEOUT and _lock_version(lock) == request.GET.get('version'):
+            timeout = LOCK_POLL_TIMEOUT
+            if lock.is_active:
+                # expiry is a change too, but nobody sends a signal for it
+                timeout = min(timeout, lock.seconds_remaining + 1)
+            event.wait(timeout)
+            lock = backend.get_blocking(cls, id, request.user)
+    finally:
+        subscriptions.unsubscribe(cls, id, event)
+
+    response = simplejson.dumps(_lock_status(lock, request.user))
+    return HttpResponse(response)
+
+@log
+@timed
 @is_lockable
+@user_may_change_model
 def unlock(request, app, model, id):
-    obj = utils.gather_lockable_models()[app][model].objects.get(pk=id)
+    cls = lockable_models.get(app, model)
 
     # Users who don't have exclusive access to an object anymore may still
     # request we unlock an object. This happens e.g. when a user navigates
     # away from an edit screen that's been open for very long.
-    # When this happens, LockableModel.unlock_for will throw an exception, 
+    # When this happens, the backend won't release the lock, 
     # and we just ignore the request.
     # That way, any new lock that may since have been put in place by another 
     # user won't get accidentally overwritten.
-    try:
-        obj.unlock_for(request.user)
-        obj.save()    
+    if get_backend().release(cls, id, request.user):
+        count('unlocks', cls)
+        signals.lock_released.send(sender=concrete_model(cls), pk=id, user=request.user)
         return HttpResponse(status=200)
-    except models.ObjectLockedError:
+    else:
         return HttpResponse(status=403)
 
 @log
-@user_may_change_model
+@timed
 @is_lockable
+@user_may_change_model
 def is_locked(request, app, model, id):    
-    obj = utils.gather_lockable_models()[app][model].objects.get(pk=id)
+    # only fetch the lock, not the (potentially large) object itself, 
+    # and if that one doesn't apply, the locks on its parents and children
+    lock = get_backend().get_blocking(lockable_models.get(app, model), id, request.user)
 
-    response = simplejson.dumps({
-        "is_active": obj.is_locked,
-        "for_user": getattr(obj.locked_by, 'username', None),
-        "applies": obj.lock_applies_to(request.user),
-        })
-    return HttpResponse(response)
+    # Browsers revalidate with If-None-Match every time, and as long as
+    # the lock stays the same, we don't need to send anything back.
+    etag = '%s-%s' % (_lock_version(lock), request.user.pk)
+    if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(simplejson.dumps(_lock_status(lock, request.user)))
+    response['ETag'] = quote_etag(etag)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+# unlocks go first, so they can free up objects for locking,
+# and status checks go last, so they reflect both
+BATCH_ACTIONS = ('unlock', 'lock', 'is_locked')
+
+def _batch_key(app, model, id):
+    return "/".join([app, model, force_unicode(id)])
+
+def _lock_version(lock):
+    # what a viewer cares about: whether the object is locked, and by whom
+    if lock.is_active:
+        return "locked-%s" % lock.locked_by_id
+    else:
+        return "unlocked"
+
+def _lock_status(lock, user):
+    return {
+        "is_active": lock.is_active,
+        "for_user": lock.username,
+        "applies": lock.applies_to(user),
+        "version": _lock_version(lock),
+        }
 
 @log
+@timed
+def batch(request):
+    """
+    Locks, unlocks and checks the status of many objects in a single request.
+    Expects a POSTed JSON list of ``[app, model, id, action]`` entries, with 
+    ``lock``, ``unlock`` or ``is_locked`` as the action. Responds with a JSON 
+    object that maps ``app/model/id`` to the status code the single-object 
+    view would have returned, plus the lock status for ``is_locked``.
+    
+    Objects of the same model are handled together, so the amount of queries
+    depends on the amount of different models, not on the amount of objects.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        groups = {}
+        for app, model, id, action in simplejson.loads(request.raw_post_data):
+            groups.setdefault((app, model), []).append((id, action))
+    except (ValueError, TypeError):
+        return HttpResponse(status=400)
+    return _batch_response(request, groups)
+
+@log
+@timed
+def release(request):
+    """
+    Unlocks many objects in a single request, meant for edit pages that are
+    being closed. Browsers send these requests as beacons, which nobody
+    waits for and which can't carry JSON, so this view expects a form-encoded
+    POST with a JSON list of ``[app, model, id]`` entries in its ``objects``
+    field. Responds like ``batch``.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        groups = {}
+        for app, model, id in simplejson.loads(request.POST.get('objects', '')):
+            groups.setdefault((app, model), []).append((id, 'unlock'))
+    except (ValueError, TypeError):
+        return HttpResponse(status=400)
+    return _batch_response(request, groups)
+
+def _batch_response(request, groups):
+    # ``groups`` maps ``(app, model)`` to a list of ``(id, action)`` entries
+    backend = get_backend()
+    statuses = {}
+    for (app, model), entries in groups.items():
+        cls = lockable_models.get(app, model)
+        # these mirror the is_lockable and user_may_change_model decorators
+        if cls is None:
+            status = 404
+        elif not may_change(request, app, model):
+            status = 401
+        else:
+            status = None
+        
+        ids = dict((action, []) for action in BATCH_ACTIONS)
+        for id, action in entries:
+            if status:
+                statuses[_batch_key(app, model, id)] = {"status": status}
+                continue
+            # a malformed entry (an id or action that's a JSON list or 
+            # object, say) is a bad request for that entry only
+            try:
+                cls._meta.pk.to_python(id)
+                ids[action].append(id)
+            except (ValidationError, KeyError, TypeError, ValueError):
+                statuses[_batch_key(app, model, id)] = {"status": 400}
+        
+        if ids['unlock']:
+            released = backend.release_many(cls, ids['unlock'], request.user)
+            count('unlocks', cls, len(released))
+            for id in released:
+                signals.lock_released.send(sender=concrete_model(cls), pk=id, user=request.user)
+            for id in ids['unlock']:
+                statuses[_batch_key(app, model, id)] = {"status": force_unicode(id) in released and 200 or 403}
+        if ids['lock']:
+            acquired = backend.acquire_many(cls, ids['lock'], request.user)
+            count('acquisitions', cls, len(acquired))
+            count('contentions', cls, len(ids['lock']) - len(acquired))
+            for id in acquired:
+                signals.lock_acquired.send(sender=concrete_model(cls), pk=id, user=request.user)
+            for id in set(force_unicode(id) for id in ids['lock']) - acquired:
+                signals.lock_contended.send(sender=concrete_model(cls), pk=id, user=request.user)
+            for id in ids['lock']:
+                statuses[_batch_key(app, model, id)] = {"status": force_unicode(id) in acquired and 200 or 403}
+        if ids['is_locked']:
+            locks = backend.get_blocking_many(cls, ids['is_locked'], request.user)
+            for id in ids['is_locked']:
+                status = _lock_status(locks[force_unicode(id)], request.user)
+                status["status"] = 200
+                statuses[_batch_key(app, model, id)] = status
+
+    return HttpResponse(simplejson.dumps(statuses), mimetype='application/json')
+
+# These variables only change when the settings or django-locking itself
+# change, so LockableAdmin adds this version to the url and browsers can
+# cache variables.js until it changes.
+JS_VARIABLES_VERSION = md5_constructor(simplejson.dumps(
+    [VERSION, LOCK_TIMEOUT, LOCK_RENEWAL_INTERVAL, LOCK_POLL_TIMEOUT])).hexdigest()[:12]
+
+@log
+@condition(etag_func=lambda request: JS_VARIABLES_VERSION)
 def js_variables(request):
-    response = "var locking = " + simplejson.dumps({
-        'base_url': "/".join(request.path.split('/')[:-1]),
+    # built anew every time: this is cheap, browsers cache the result, and
+    # any path that ends in variables.js ends up here, so keeping one per
+    # path around would grow without bound
+    base_url = "/".join(request.path.split('/')[:-1])
+    js = "var locking = " + simplejson.dumps({
+        'base_url': base_url,
         'timeout': LOCK_TIMEOUT,
+        'renewal_interval': LOCK_RENEWAL_INTERVAL,
+        'poll_timeout': LOCK_POLL_TIMEOUT,
         })
-    return HttpResponse(response)
\ No newline at end of file
+    response = HttpResponse(js, mimetype='text/javascript')
+    if request.GET.get('v') == JS_VARIABLES_VERSION:
+        patch_cache_control(response, public=True, max_age=365 * 24 * 60 * 60)
+    return response
+
+def metrics(request):
+    """
+    Serves the lock metrics in a text exposition format (see ``locking.metrics``),
+    to staff members and to ``INTERNAL_IPS``.
+    """
+    if not request.user.is_staff and \
+        request.META.get('REMOTE_ADDR') not in settings.INTERNAL_IPS:
+        return HttpResponse(status=401)
+    return HttpResponse(get_collector().render(), mimetype='text/plain; version=0.0.4')